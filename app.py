@@ -8,14 +8,21 @@ from streamlit_calendar import calendar
 from fpdf import FPDF
 import tempfile
 import os
-from PIL import Image
+from PIL import Image, ImageOps, features
 import io
 import shutil
+import threading
+import queue
+import zlib
+import gzip
+import random
+import re
 
 # --- BIBLIOTECAS GOOGLE DRIVE ---
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 
 # ==========================================
 # 1. CONFIGURAÇÃO DA PÁGINA
@@ -29,134 +36,1971 @@ st.set_page_config(
 DB_FILE = 'gk_master_v38.db'
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+# "shared": uma única DB_FILE; "sharded": uma DB por treinador + AUTH_DB_FILE com os utilizadores
+STORAGE_MODE = st.secrets.get("storage", {}).get("mode", "shared")
+AUTH_DB_FILE = 'gk_auth.db'
+
+# Armazém de ficheiros (imagens, PDFs) endereçado pelo SHA-256 do conteúdo, partilhado por todas as DBs
+BLOB_DB_FILE = 'gk_blobs.db'
+BLOB_READ_CHUNK = 256 * 1024
+
+# Imagens carregadas: lado máximo, formato e qualidade depois da normalização
+IMAGE_MAX_SIDE = int(st.secrets.get("images", {}).get("max_side", 1600))
+IMAGE_FORMAT = st.secrets.get("images", {}).get("format", "WEBP").upper()
+IMAGE_QUALITY = int(st.secrets.get("images", {}).get("quality", 82))
+
+# Miniaturas do catálogo de exercícios (cache local em BLOB_DB_FILE, limitada em bytes)
+THUMB_MAX_SIDE = 320
+THUMB_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Entradas máximas na cache de consultas das tabelas de referência (DataFrames pequenos)
+QUERY_CACHE_MAX_ENTRIES = 256
+
+# Pool de ligações SQLite por ficheiro e afinação de cada ligação
+SQLITE_POOL_SIZE = 8
+SQLITE_CACHE_KB = 32 * 1024
+SQLITE_MMAP_BYTES = 256 * 1024 * 1024
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# Atraso (segundos) do backup automático: a 1ª escrita agenda-o e as seguintes agrupam-se nele
+BACKUP_WINDOW_S = int(st.secrets.get("drive", {}).get("backup_window_s", 120))
+# Sinais pendentes para acordar o worker e tamanho de cada bloco resumível (múltiplo de 256 KB)
+UPLOAD_QUEUE_SIZE = 1
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# "full" envia a DB inteira; "delta" envia só as páginas SQLite alteradas
+SYNC_MODE = st.secrets.get("drive", {}).get("sync_mode", "full")
+# Nova base completa após N deltas ou quando mais de X% das páginas mudou
+DELTA_MAX_CHAIN = 20
+DELTA_MAX_RATIO = 0.5
+# Páginas copiadas por passo da API de backup do SQLite nos snapshots
+SNAPSHOT_STEP_PAGES = 256
+# Outbox persistente dos envios falhados/pendentes e o seu backoff (segundos)
+OUTBOX_FILE = 'gk_sync_outbox.db'
+RETRY_BASE_S = 5
+RETRY_MAX_S = 30 * 60
+
 # ==========================================
 # 2. FUNÇÕES DE GOOGLE DRIVE & DB
 # ==========================================
 
+@st.cache_resource
+def _build_drive_service():
+    creds = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"], scopes=SCOPES)
+    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+
 def get_drive_service():
-    """Autentica no Google Drive."""
+    """Autentica no Google Drive (cliente criado uma vez por processo)."""
     try:
         if "gcp_service_account" in st.secrets:
-            creds = service_account.Credentials.from_service_account_info(
-                st.secrets["gcp_service_account"], scopes=SCOPES)
-            return build('drive', 'v3', credentials=creds)
+            return _build_drive_service()
         return None
     except Exception as e:
         return None
 
-def sync_download_db():
-    """Baixa a DB do Drive."""
+@st.cache_resource
+def get_drive_lock():
+    """O cliente HTTP da Google não é thread-safe: serializa cada pedido."""
+    return threading.Lock()
+
+@st.cache_resource
+def get_drive_file_ids():
+    """Cache nome do ficheiro -> ID no Drive, partilhada pelo processo."""
+    return {}
+
+def drive_enabled():
+    return "gcp_service_account" in st.secrets and "drive" in st.secrets
+
+def get_drive_file_id(service, name=DB_FILE):
+    """Devolve o ID do ficheiro na pasta do Drive, consultando a API só na 1ª vez."""
+    ids = get_drive_file_ids()
+    if name in ids:
+        return ids[name]
+    fid = st.secrets["drive"]["folder_id"]
+    q = f"'{fid}' in parents and name = '{name}' and trashed = false"
+    with get_drive_lock():
+        res = service.files().list(q=q, fields="files(id)").execute()
+    files = res.get('files', [])
+    if not files:
+        return None
+    ids[name] = files[0]['id']
+    return ids[name]
+
+def is_not_found(e):
+    return isinstance(e, HttpError) and e.resp.status == 404
+
+def with_drive_file(service, name, fn):
+    """Executa fn(file_id); se o ID em cache der 404, procura-o de novo uma única vez."""
+    for attempt in range(2):
+        try:
+            return fn(get_drive_file_id(service, name))
+        except HttpError as e:
+            # ID em cache já não existe (ficheiro apagado/recriado)
+            if not is_not_found(e) or attempt:
+                raise
+            get_drive_file_ids().pop(name, None)
+
+def drive_upload_file(service, path, name, mimetype='application/octet-stream', progress=None, app_properties=None):
+    """Envia um ficheiro em blocos resumíveis (atualiza ou cria). Devolve os metadados remotos."""
+    def run(file_id):
+        media = MediaFileUpload(path, mimetype=mimetype, resumable=True, chunksize=UPLOAD_CHUNK_SIZE)
+        fields = "id,md5Checksum,modifiedTime,appProperties"
+        body = {'appProperties': app_properties} if app_properties else {}
+        if file_id:
+            req = service.files().update(fileId=file_id, body=body, media_body=media, fields=fields)
+        else:
+            body.update({'name': name, 'parents': [st.secrets["drive"]["folder_id"]]})
+            req = service.files().create(body=body, media_body=media, fields=fields)
+        resp = None
+        while resp is None:
+            with get_drive_lock():
+                status, resp = req.next_chunk()
+            if status and progress:
+                progress(status.progress())
+        get_drive_file_ids()[name] = resp['id']
+        return resp
+    return with_drive_file(service, name, run)
+
+def drive_file_meta(service, name):
+    """Metadados (md5Checksum, modifiedTime, size) do ficheiro no Drive, ou None."""
+    def run(file_id):
+        if not file_id:
+            return None
+        with get_drive_lock():
+            return service.files().get(fileId=file_id, fields="id,md5Checksum,modifiedTime,size,appProperties").execute()
+    return with_drive_file(service, name, run)
+
+def drive_download_to(service, name, fh):
+    """Descarrega o ficheiro do Drive em streaming para fh. Devolve False se não existe."""
+    def run(file_id):
+        if not file_id:
+            return False
+        fh.seek(0); fh.truncate()
+        dl = MediaIoBaseDownload(fh, service.files().get_media(fileId=file_id), chunksize=UPLOAD_CHUNK_SIZE)
+        done = False
+        while not done:
+            with get_drive_lock():
+                _, done = dl.next_chunk()
+        return True
+    return with_drive_file(service, name, run)
+
+def drive_delete_file(service, name):
+    file_id = get_drive_file_id(service, name)
+    if file_id:
+        with get_drive_lock():
+            service.files().delete(fileId=file_id).execute()
+        get_drive_file_ids().pop(name, None)
+
+def raw_md5(remote):
+    """md5 do conteúdo SQLite (a cópia no Drive pode estar comprimida)."""
+    return (remote.get("appProperties") or {}).get("raw_md5") or remote.get("md5Checksum")
+
+def snapshot_db(dest, db_file=DB_FILE):
+    """Cópia transacionalmente consistente pela API de backup do SQLite.
+
+    Copia SNAPSHOT_STEP_PAGES páginas de cada vez, largando o lock entre passos
+    para não bloquear as escritas das outras sessões.
+    """
+    src = sqlite3.connect(db_file)
+    dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst, pages=SNAPSHOT_STEP_PAGES, sleep=0.005)
+    finally:
+        dst.close()
+        src.close()
+
+def drive_upload_db_file(service, snap, name, progress=None):
+    """Comprime o snapshot com gzip e envia-o, guardando o md5 original nas appProperties."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".db.gz") as tf:
+        gz_path = tf.name
+    try:
+        with open(snap, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        props = {"encoding": "gzip", "raw_md5": file_md5(snap)}
+        return drive_upload_file(service, gz_path, name, 'application/gzip', progress, props)
+    finally:
+        os.unlink(gz_path)
+
+def drive_download_db_file(service, name, dest, meta=None):
+    """Descarrega a DB para dest, descomprimindo se foi enviada em gzip. Devolve os metadados."""
+    meta = meta or drive_file_meta(service, name)
+    if not meta:
+        return None
+    if (meta.get("appProperties") or {}).get("encoding") == "gzip":
+        gz_path = dest + ".gz"
+        try:
+            with open(gz_path, "wb") as fh:
+                drive_download_to(service, name, fh)
+            with gzip.open(gz_path, "rb") as src, open(dest, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        finally:
+            if os.path.exists(gz_path):
+                os.unlink(gz_path)
+    else:
+        with open(dest, "wb") as fh:
+            drive_download_to(service, name, fh)
+    if raw_md5(meta) and file_md5(dest) != raw_md5(meta):
+        raise IOError("Download corrompido (md5 diferente)")
+    return meta
+
+def file_md5(path, chunk=1024 * 1024):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def read_sync_state(db_file=DB_FILE):
+    """Estado da última sincronização (md5/modifiedTime do Drive e stat local)."""
+    try:
+        with open(db_file + ".sync.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_sync_state(db_file, remote, local_stat):
+    state = {"md5": raw_md5(remote), "modifiedTime": remote.get("modifiedTime"),
+             "size": local_stat.st_size, "mtime_ns": local_stat.st_mtime_ns}
+    with open(db_file + ".sync.json", "w") as f:
+        json.dump(state, f)
+
+def local_unchanged_since_sync(db_file=DB_FILE):
+    if not os.path.exists(db_file):
+        return False
+    stt = os.stat(db_file)
+    state = read_sync_state(db_file)
+    return state.get("size") == stt.st_size and state.get("mtime_ns") == stt.st_mtime_ns
+
+def local_db_md5(db_file=DB_FILE):
+    """md5 da DB local, reaproveitando o guardado se o ficheiro não mudou desde a última sync."""
+    if not os.path.exists(db_file):
+        return None
+    if local_unchanged_since_sync(db_file):
+        return read_sync_state(db_file).get("md5")
+    return file_md5(db_file)
+
+def local_db_ahead(db_file=DB_FILE):
+    """True se há escritas locais ainda não enviadas (não se pode substituir a DB).
+    O backup agendado fica na outbox em disco até ao fim do envio, por isso isto sobrevive a um reinício."""
+    return get_upload_worker().outbox.pending("backup", db_file) > 0
+
+# --- SINCRONIZAÇÃO INCREMENTAL (BASE + DELTAS DE PÁGINAS SQLITE) ---
+# No Drive: '<db>' (base completa), '<db>.delta.NNNNNN' (páginas alteradas, zlib)
+# e '<db>.manifest.json' (md5 da base + lista ordenada de deltas).
+
+def sqlite_page_size(path):
+    with open(path, "rb") as f:
+        ps = int.from_bytes(f.read(100)[16:18], "big")
+    return 65536 if ps == 1 else ps
+
+def page_digests(path, page_size):
+    with open(path, "rb") as f:
+        return [hashlib.blake2b(block, digest_size=8).digest() for block in iter(lambda: f.read(page_size), b"")]
+
+def load_page_digests(db_file=DB_FILE):
+    try:
+        with open(db_file + ".pages", "rb") as f:
+            raw = f.read()
+        return [raw[i:i + 8] for i in range(0, len(raw), 8)]
+    except OSError:
+        return []
+
+def save_page_digests(db_file, digests):
+    with open(db_file + ".pages", "wb") as f:
+        f.write(b"".join(digests))
+
+def read_local_manifest(db_file=DB_FILE):
+    try:
+        with open(db_file + ".manifest.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_local_manifest(db_file, manifest):
+    with open(db_file + ".manifest.json", "w") as f:
+        json.dump(manifest, f)
+
+def build_delta(path, page_size, pages, page_count):
+    """Empacota as páginas alteradas: cabeçalho (tamanho página, nº páginas) + (nº, bytes)."""
+    out = io.BytesIO()
+    out.write(b"GKD1" + page_size.to_bytes(4, "big") + page_count.to_bytes(4, "big"))
+    with open(path, "rb") as f:
+        for p in pages:
+            f.seek(p * page_size)
+            out.write(p.to_bytes(4, "big") + f.read(page_size))
+    return zlib.compress(out.getvalue(), 6)
+
+def apply_delta(path, blob):
+    raw = zlib.decompress(blob)
+    if raw[:4] != b"GKD1":
+        raise ValueError("Delta inválido")
+    page_size = int.from_bytes(raw[4:8], "big")
+    page_count = int.from_bytes(raw[8:12], "big")
+    with open(path, "r+b") as f:
+        pos = 12
+        while pos < len(raw):
+            p = int.from_bytes(raw[pos:pos + 4], "big")
+            f.seek(p * page_size)
+            f.write(raw[pos + 4:pos + 4 + page_size])
+            pos += 4 + page_size
+        f.truncate(page_count * page_size)
+
+def upload_db_delta(service, snap, db_file, progress=None):
+    """Envia só as páginas alteradas desde a última sync (ou uma base nova quando compensa)."""
+    name = os.path.basename(db_file)
+    page_size = sqlite_page_size(snap)
+    new = page_digests(snap, page_size)
+    old = load_page_digests(db_file)
+    manifest = read_local_manifest(db_file)
+    deltas = manifest.get("deltas", [])
+    changed = [i for i, d in enumerate(new) if i >= len(old) or old[i] != d]
+    rebase = (not old or manifest.get("page_size") != page_size or len(deltas) >= DELTA_MAX_CHAIN
+              or len(changed) > DELTA_MAX_RATIO * len(new))
+    if not rebase and not changed and len(new) == len(old):
+        return {}
+    seq = manifest.get("next_seq", 1)
+    if rebase:
+        remote = drive_upload_db_file(service, snap, name, progress)
+        stale = deltas
+        manifest = {"base_md5": raw_md5(remote), "page_size": page_size, "deltas": [], "next_seq": seq}
+    else:
+        d_name = f"{name}.delta.{seq:06d}"
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".delta") as tf:
+            tf.write(build_delta(snap, page_size, changed, len(new)))
+        try:
+            remote = drive_upload_file(service, tf.name, d_name, progress=progress)
+        finally:
+            os.unlink(tf.name)
+        stale = []
+        manifest["deltas"] = deltas + [{"name": d_name, "pages": len(changed)}]
+        manifest["next_seq"] = seq + 1
+    manifest["page_count"] = len(new)
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json") as tf:
+        json.dump(manifest, tf)
+    try:
+        drive_upload_file(service, tf.name, f"{name}.manifest.json", 'application/json')
+    finally:
+        os.unlink(tf.name)
+    write_local_manifest(db_file, manifest)
+    save_page_digests(db_file, new)
+    for d in stale:
+        try:
+            drive_delete_file(service, d["name"])
+        except HttpError:
+            pass
+    return remote
+
+def restore_db_delta(service, db_file, tmp_path):
+    """Reconstrói a DB em tmp_path a partir da base + deltas do Drive.
+
+    Devolve o manifesto remoto, False se já está atualizada, ou None se não há manifesto.
+    """
+    name = os.path.basename(db_file)
+    buf = io.BytesIO()
+    if not drive_download_to(service, f"{name}.manifest.json", buf):
+        return None
+    remote = json.loads(buf.getvalue())
+    local = read_local_manifest(db_file)
+    local_ok = local_unchanged_since_sync(db_file) and local.get("base_md5") == remote.get("base_md5")
+    local_names = [d["name"] for d in local.get("deltas", [])]
+    remote_names = [d["name"] for d in remote.get("deltas", [])]
+    if local_ok and local_names == remote_names:
+        return False
+    if local_ok and remote_names[:len(local_names)] == local_names:
+        # A DB local é a base + um prefixo dos deltas: aplicar só os que faltam
+        shutil.copyfile(db_file, tmp_path)
+        todo = remote_names[len(local_names):]
+    else:
+        base = drive_download_db_file(service, name, tmp_path)
+        # Se a base foi substituída depois do manifesto, já contém tudo o que os deltas tinham
+        todo = remote_names if raw_md5(base) == remote.get("base_md5") else []
+    for d_name in todo:
+        buf = io.BytesIO()
+        drive_download_to(service, d_name, buf)
+        apply_delta(tmp_path, buf.getvalue())
+    return remote
+
+def sync_download_db(db_file=DB_FILE, force=False):
+    """Baixa a DB do Drive só se for diferente da local. Devolve True se a substituiu."""
+    service = get_drive_service()
+    if not (service and drive_enabled()):
+        return False
+    if not force and local_db_ahead(db_file):
+        return False
+    name = os.path.basename(db_file)
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    tmp = None
+    try:
+        # Em WAL as escritas recentes só chegam ao ficheiro principal no checkpoint
+        checkpoint_db(db_file)
+        with tempfile.NamedTemporaryFile(dir=db_dir, prefix=".dl_", suffix=".db", delete=False) as fh:
+            tmp = fh.name
+        manifest = restore_db_delta(service, db_file, tmp) if SYNC_MODE == "delta" else None
+        if manifest is False:
+            return False
+        if manifest is None:
+            remote = drive_file_meta(service, name)
+            if not remote:
+                return False
+            if os.path.exists(db_file):
+                state = read_sync_state(db_file)
+                # Atalho: nada mudou no Drive nem localmente desde a última sync
+                if local_unchanged_since_sync(db_file) and state.get("modifiedTime") == remote.get("modifiedTime"):
+                    return False
+                if raw_md5(remote) and local_db_md5(db_file) == raw_md5(remote):
+                    write_sync_state(db_file, remote, os.stat(db_file))
+                    return False
+            # Download em streaming para um temporário na mesma pasta e troca atómica
+            drive_download_db_file(service, name, tmp, remote)
+        replace_db_file(tmp, db_file)
+        tmp = None
+        if manifest:
+            write_local_manifest(db_file, manifest)
+            save_page_digests(db_file, page_digests(db_file, sqlite_page_size(db_file)))
+            remote = {}
+        write_sync_state(db_file, remote, os.stat(db_file))
+        return True
+    except Exception as e:
+        get_upload_worker().note_error(f"Download: {e}")
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+    return False
+
+def upload_db_to_drive(snap, db_file=DB_FILE, progress=None):
+    """Envia o snapshot da DB para o Drive (completo ou incremental, conforme SYNC_MODE).
+
+    Devolve os metadados remotos (ou False) e lança exceção em caso de erro.
+    """
     service = get_drive_service()
-    if "drive" in st.secrets:
-        fid = st.secrets["drive"]["folder_id"]
-        if service and fid:
+    if not (service and drive_enabled() and os.path.exists(snap)):
+        return False
+    name = os.path.basename(db_file)
+    if SYNC_MODE == "delta":
+        # Em modo delta o estado remoto fica no manifesto, não nos metadados da base
+        upload_db_delta(service, snap, db_file, progress)
+        return {}
+    return drive_upload_db_file(service, snap, name, progress)
+
+class SyncOutbox:
+    """Fila persistente (SQLite em disco) de envios para o Drive, com retry e backoff."""
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS sync_jobs (id INTEGER PRIMARY KEY, kind TEXT, target TEXT, reason TEXT,
+                            writes INTEGER DEFAULT 0, rev INTEGER DEFAULT 0, attempts INTEGER DEFAULT 0, next_attempt REAL, last_error TEXT, created TEXT)''')
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_jobs_target ON sync_jobs(kind, target)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, kind, target, reason, n=0, delay=0):
+        """Acrescenta um job para daqui a `delay` s. Se já existe um pendente para o mesmo alvo,
+        agrupa-o (sem mudar a hora marcada) e devolve False."""
+        conn = self._connect()
+        try:
+            cur = conn.execute("UPDATE sync_jobs SET writes = writes + ?, rev = rev + 1, reason = ? WHERE kind=? AND target=?", (n, reason, kind, target))
+            if cur.rowcount == 0:
+                conn.execute("INSERT INTO sync_jobs (kind, target, reason, writes, next_attempt, created) VALUES (?,?,?,?,?,?)",
+                             (kind, target, reason, n, datetime.now().timestamp() + delay, datetime.now().isoformat(timespec='seconds')))
+            conn.commit()
+            return cur.rowcount == 0
+        finally:
+            conn.close()
+
+    def next_due(self):
+        """Próximo job cuja hora de tentativa já chegou, como dict, ou None."""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute("SELECT * FROM sync_jobs WHERE next_attempt <= ? ORDER BY next_attempt LIMIT 1", (datetime.now().timestamp(),)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    def seconds_to_next(self):
+        conn = self._connect()
+        try:
+            nxt = conn.execute("SELECT min(next_attempt) FROM sync_jobs").fetchone()[0]
+        finally:
+            conn.close()
+        return None if nxt is None else max(0.0, nxt - datetime.now().timestamp())
+
+    def done(self, job):
+        conn = self._connect()
+        try:
+            # Só apaga se não chegaram novos pedidos enquanto o job corria
+            conn.execute("DELETE FROM sync_jobs WHERE id=? AND rev=?", (job['id'], job['rev']))
+            conn.execute("UPDATE sync_jobs SET writes = writes - ?, attempts = 0, next_attempt = ? WHERE id=?",
+                         (job['writes'], datetime.now().timestamp(), job['id']))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def failed(self, job, error):
+        """Reagenda com backoff exponencial (com jitter) limitado a RETRY_MAX_S."""
+        attempts = job['attempts'] + 1
+        delay = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE sync_jobs SET attempts=?, next_attempt=?, last_error=? WHERE id=?",
+                         (attempts, datetime.now().timestamp() + delay, error[:500], job['id']))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def expedite(self, kind, target):
+        """Antecipa para já um job agendado para mais tarde."""
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE sync_jobs SET next_attempt = min(next_attempt, ?) WHERE kind=? AND target=?",
+                         (datetime.now().timestamp(), kind, target))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def pending_writes(self, kind, target):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT coalesce(sum(writes), 0) FROM sync_jobs WHERE kind=? AND target=?", (kind, target)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def pending(self, kind=None, target=None):
+        conn = self._connect()
+        try:
+            q = "SELECT count(*) FROM sync_jobs WHERE (? IS NULL OR kind=?) AND (? IS NULL OR target=?)"
+            return conn.execute(q, (kind, kind, target, target)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def jobs(self):
+        conn = self._connect()
+        try:
+            df = pd.read_sql_query("SELECT kind, target, reason, writes, attempts, next_attempt, last_error FROM sync_jobs ORDER BY next_attempt", conn)
+        finally:
+            conn.close()
+        df['next_attempt'] = pd.to_datetime(df['next_attempt'], unit='s')
+        return df
+
+class UploadWorker:
+    """Thread única do processo que executa os jobs da outbox (snapshots e envios para o Drive)."""
+    def __init__(self, maxsize, outbox):
+        self.queue = queue.Queue(maxsize=maxsize)  # só serve para acordar a thread
+        self.outbox = outbox
+        self.handlers = {"backup": self._backup, "blob": self._blobs, "gc": self._gc}
+        self.lock = threading.Lock()
+        self.current = None
+        self.progress = 0.0
+        self.last_success = None
+        self.last_error = None
+        self.thread = threading.Thread(target=self._run, name="gk-drive-upload", daemon=True)
+        self.thread.start()
+
+    def submit(self, kind, target, reason, n=0, delay=0):
+        """Guarda o job na outbox e acorda o worker. Devolve False se foi agrupado num pendente."""
+        added = self.outbox.add(kind, target, reason, n, delay)
+        self.wake()
+        return added
+
+    def wake(self):
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def note_error(self, msg):
+        with self.lock:
+            self.last_error = (datetime.now(), msg)
+
+    def _set_progress(self, p):
+        with self.lock:
+            self.progress = p
+
+    def _backup(self, job):
+        snap = None
+        try:
+            # O snapshot é tirado só agora, por isso cobre todas as escritas feitas até aqui
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as tf:
+                snap = tf.name
+            checkpoint_db(job['target'])
+            local_stat = os.stat(job['target'])
+            snapshot_db(snap, job['target'])
+            remote = upload_db_to_drive(snap, job['target'], self._set_progress)
+            if remote is False:
+                raise RuntimeError("Google Drive não configurado")
+            write_sync_state(job['target'], remote, local_stat)
+        finally:
+            if snap and os.path.exists(snap):
+                os.unlink(snap)
+
+    def _blobs(self, job):
+        upload_new_blobs(job['target'], self._set_progress)
+
+    def _gc(self, job):
+        sweep_blobs(self._set_progress)
+
+    def _run(self):
+        while True:
             try:
-                q = f"'{fid}' in parents and name = '{DB_FILE}' and trashed = false"
-                res = service.files().list(q=q, fields="files(id)").execute()
-                files = res.get('files', [])
-                if files:
-                    req = service.files().get_media(fileId=files[0]['id'])
-                    fh = io.BytesIO()
-                    dl = MediaIoBaseDownload(fh, req)
-                    done = False
-                    while not done:
-                        _, done = dl.next_chunk()
-                    with open(DB_FILE, "wb") as f:
-                        f.write(fh.getbuffer())
-            except:
+                self._step()
+            except Exception as e:
+                # A thread nunca pode morrer (ex.: outbox bloqueada ao reagendar): regista e tenta de novo
+                self.note_error(f"Worker: {e}")
+                try:
+                    self.queue.get(timeout=RETRY_BASE_S)
+                except queue.Empty:
+                    pass
+
+    def _step(self):
+        """Corre o próximo job vencido ou espera pelo seguinte (ou por um submit)."""
+        try:
+            job = self.outbox.next_due()
+            wait = self.outbox.seconds_to_next() if job is None else 0
+        except Exception as e:
+            self.note_error(f"Outbox: {e}")
+            job, wait = None, RETRY_BASE_S
+        if job is None:
+            try:
+                self.queue.get(timeout=min(wait, 60) if wait is not None else 60)
+            except queue.Empty:
                 pass
+            return
+        with self.lock:
+            self.current = f"{job['kind']}: {job['reason']}"
+            self.progress = 0.0
+        ok = False
+        try:
+            self.handlers[job['kind']](job)
+            self.outbox.done(job)
+            ok = True
+            with self.lock:
+                self.last_success = datetime.now()
+                self.progress = 1.0
+        except Exception as e:
+            self.note_error(str(e))
+            self.outbox.failed(job, str(e))
+        finally:
+            with self.lock:
+                self.current = None
+            if job['kind'] == "backup":
+                get_backup_scheduler(job['target']).record(job['reason'], job['writes'], ok)
+
+@st.cache_resource
+def get_upload_worker():
+    """Worker de envio partilhado por todas as sessões do processo."""
+    return UploadWorker(UPLOAD_QUEUE_SIZE, SyncOutbox(OUTBOX_FILE))
+
+def backup_to_drive(reason="manual", n=0, db_file=DB_FILE, delay=0):
+    """Pede um backup ao worker em segundo plano; não bloqueia a interface.
+    Com delay o job espera na outbox e as escritas seguintes agrupam-se nele."""
+    if not drive_enabled():
+        return
+    worker = get_upload_worker()
+    if worker.submit("backup", db_file, reason, n, delay) or delay:
+        return
+    # Já existe um backup pendente: passa a correr já e o snapshot dele inclui estas escritas
+    worker.outbox.expedite("backup", db_file)
+    worker.wake()
+    get_backup_scheduler(db_file).record(f"{reason} (agrupado)", n, True)
+
+class BackupScheduler:
+    """Histórico dos backups de uma DB; as escritas por enviar vivem na outbox."""
+    def __init__(self, window_s):
+        self.window_s = window_s
+        self.lock = threading.Lock()
+        self.last_flush = None
+        self.history = []  # (data, motivo, escritas agrupadas, sucesso)
+
+    def record(self, reason, n, ok):
+        # Um envio falhado continua na outbox e é repetido pelo worker
+        with self.lock:
+            if ok:
+                self.last_flush = datetime.now()
+            self.history.insert(0, (datetime.now(), reason, n, ok))
+            del self.history[20:]
+
+@st.cache_resource
+def get_backup_scheduler(db_file=DB_FILE):
+    """Histórico de cada ficheiro de DB, partilhado por todas as sessões do processo."""
+    return BackupScheduler(BACKUP_WINDOW_S)
+
+def flush_backup(reason="manual", db_file=None):
+    """Envia a DB já: antecipa o backup agendado ou pede um novo."""
+    backup_to_drive(reason, 0, db_file or current_db_file())
+
+def schedule_backup(db_file=None):
+    """Regista uma escrita. A 1ª agenda na outbox um backup para daqui a BACKUP_WINDOW_S
+    e as seguintes agrupam-se nele; por estar em disco, não se perde se o processo reiniciar."""
+    backup_to_drive("janela", 1, db_file or current_db_file(), delay=BACKUP_WINDOW_S)
+
+# --- ARMAZENAMENTO: DB ÚNICA OU UMA DB POR TREINADOR ---
+# Em modo "sharded" os utilizadores ficam em AUTH_DB_FILE e os dados de cada
+# treinador num ficheiro próprio, por isso cada sync só leva os dados de um treinador.
+
+def user_db_file(user):
+    slug = re.sub(r'[^A-Za-z0-9_-]', '_', user)[:32]
+    return f"gk_user_{slug}_{hashlib.sha1(user.encode()).hexdigest()[:8]}.db"
+
+def auth_db_file():
+    return AUTH_DB_FILE if STORAGE_MODE == "sharded" else DB_FILE
+
+def current_db_file():
+    """Ficheiro de DB do treinador com sessão iniciada (ou a DB única)."""
+    if STORAGE_MODE == "sharded" and st.session_state.get('username'):
+        return user_db_file(st.session_state['username'])
+    return DB_FILE
+
+# --- POOL DE LIGAÇÕES SQLITE ---
+
+class PooledConnection(sqlite3.Connection):
+    """Ligação do pool: close() devolve-a ao pool em vez de a fechar."""
+    pool = None
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        if self.in_transaction:
+            self.rollback()
+        self.pool.release(self)
+
+class ConnectionPool:
+    """Ligações já abertas e afinadas (WAL, cache, mmap) a um ficheiro de DB."""
+    def __init__(self, db_file, size):
+        self.db_file = db_file
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.generation = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, factory=PooledConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.pool = self
+        conn.generation = self.generation
+        return conn
+
+    def acquire(self):
+        """Cada ligação só é usada por uma thread de cada vez (até voltar com close())."""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, conn):
+        if conn.generation != self.generation or self.idle.qsize() >= self.size:
+            sqlite3.Connection.close(conn)
+        else:
+            self.idle.put(conn)
 
-def backup_to_drive():
-    """Envia a DB para o Drive."""
-    service = get_drive_service()
-    if "drive" in st.secrets:
-        fid = st.secrets["drive"]["folder_id"]
-        if service and fid and os.path.exists(DB_FILE):
+    def close_all(self):
+        """Fecha as ligações livres e invalida as emprestadas (ex.: antes de substituir o ficheiro)."""
+        self.generation += 1
+        while True:
             try:
-                q = f"'{fid}' in parents and name = '{DB_FILE}' and trashed = false"
-                res = service.files().list(q=q, fields="files(id)").execute()
-                files = res.get('files', [])
-                media = MediaFileUpload(DB_FILE, mimetype='application/x-sqlite3', resumable=True)
-                if files:
-                    service.files().update(fileId=files[0]['id'], media_body=media).execute()
-                st.toast("Backup Cloud OK!", icon="☁️")
-            except:
-                st.error("Erro Backup Cloud")
+                sqlite3.Connection.close(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+@st.cache_resource
+def get_connection_pool(db_file):
+    return ConnectionPool(db_file, SQLITE_POOL_SIZE)
+
+def get_db_connection(db_file=None):
+    return get_connection_pool(db_file or current_db_file()).acquire()
+
+def get_auth_connection():
+    return get_db_connection(auth_db_file())
+
+def checkpoint_db(db_file):
+    """Passa o WAL para o ficheiro principal (para stat/md5/cópias do ficheiro em bruto)."""
+    if os.path.exists(db_file):
+        conn = get_db_connection(db_file)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
+def replace_db_file(src, db_file):
+    """Substitui a DB local por src de forma atómica, descartando ligações e o WAL antigos."""
+    get_connection_pool(db_file).close_all()
+    for ext in ("-wal", "-shm"):
+        if os.path.exists(db_file + ext):
+            os.unlink(db_file + ext)
+    os.replace(src, db_file)
+    get_query_cache().drop_db(db_file)
+
+def init_auth_db():
+    """A DB de autenticação partilhada só tem a tabela users (copiada da DB única na 1ª vez)."""
+    conn = get_auth_connection()
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)")
+        empty = conn.execute("SELECT count(*) FROM users").fetchone()[0] == 0
+        if empty and os.path.exists(DB_FILE):
+            conn.execute("ATTACH DATABASE ? AS legacy", (DB_FILE,))
+            if conn.execute("SELECT 1 FROM legacy.sqlite_master WHERE name='users'").fetchone():
+                conn.execute("INSERT INTO users SELECT username, password FROM legacy.users")
+            conn.commit()
+            conn.execute("DETACH DATABASE legacy")
+        conn.commit()
+    finally:
+        conn.close()
+
+def split_user_shard(user, shard):
+    """Cria o ficheiro próprio do treinador com as suas linhas da DB única.
+
+    A DB única pode estar num esquema antigo (ações técnicas em colunas, fichas duplicadas):
+    copia-se e migra-se essa cópia antes de separar. A shard é montada num ficheiro temporário
+    e só substitui `shard` se tudo correr bem; a DB única nunca é alterada.
+    """
+    db_dir = os.path.dirname(os.path.abspath(shard))
+    tmps = []
+    for prefix in (".legacy_", ".split_"):
+        with tempfile.NamedTemporaryFile(dir=db_dir, prefix=prefix, suffix=".db", delete=False) as fh:
+            tmps.append(fh.name)
+    legacy, tmp = tmps
+    try:
+        snapshot_db(legacy, DB_FILE)
+        conn = sqlite3.connect(legacy)
+        try:
+            migrate_db(conn)
+        finally:
+            conn.close()
+        conn = sqlite3.connect(tmp)
+        try:
+            migrate_db(conn)
+            conn.execute("ATTACH DATABASE ? AS legacy", (legacy,))
+            legacy_tables = {r[0] for r in conn.execute("SELECT name FROM legacy.sqlite_master WHERE type='table'")}
+            owned = {
+                "goalkeepers": "user_id = :u", "exercises": "user_id = :u", "sessions": "user_id = :u",
+                "microcycles": "user_id = :u", "training_ratings": "user_id = :u", "opponents": "user_id = :u",
+                "library_folders": "user_id = :u", "matches": "user_id = :u", "games": "user_id = :u",
+                "match_actions": "line_id IN (SELECT id FROM legacy.matches WHERE user_id = :u)",
+                "attendance": "session_id IN (SELECT id FROM legacy.sessions WHERE user_id = :u)",
+                "injuries": "gk_id IN (SELECT id FROM legacy.goalkeepers WHERE user_id = :u)",
+                "opponent_files": "opponent_id IN (SELECT id FROM legacy.opponents WHERE user_id = :u)",
+                "library_files": "folder_id IN (SELECT id FROM legacy.library_folders WHERE user_id = :u)",
+            }
+            for table, where in owned.items():
+                if table not in legacy_tables:
+                    continue
+                # Por nome de coluna: as DBs antigas têm as colunas do ALTER TABLE noutra ordem
+                cols_new = [r[1] for r in conn.execute(f"PRAGMA main.table_info({table})")]
+                cols_old = {r[1] for r in conn.execute(f"PRAGMA legacy.table_info({table})")}
+                cols = ", ".join(c for c in cols_new if c in cols_old)
+                conn.execute(f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM legacy.{table} WHERE {where}", {"u": user})
+            rebuild_match_kpis(conn, user)
+            rebuild_rating_trends(conn, user)
+            conn.commit()
+            conn.execute("DETACH DATABASE legacy")
+        finally:
+            conn.close()
+        replace_db_file(tmp, shard)
+    finally:
+        for path in tmps:
+            for ext in ("", "-wal", "-shm", "-journal"):
+                if os.path.exists(path + ext):
+                    os.unlink(path + ext)
+
+def prepare_user_db(user):
+    """Modo sharded: garante que a DB do treinador está sincronizada e migrada.
+    Devolve False se a separação da DB única falhou (nada fica gravado; tenta de novo no próximo acesso)."""
+    shard = user_db_file(user)
+    sync_download_db(shard)
+    if not os.path.exists(shard):
+        # 1ª vez: separar os dados deste treinador da antiga DB única
+        if not os.path.exists(DB_FILE):
+            sync_download_db(DB_FILE)
+        if os.path.exists(DB_FILE):
+            try:
+                split_user_shard(user, shard)
+            except Exception as e:
+                st.error(f"Erro ao separar os dados do treinador (nada foi gravado): {e}")
+                return False
+        check_db_updates(shard)
+        schedule_backup(shard)
+        return True
+    check_db_updates(shard)
+    return True
+
+# --- CACHE DE CONSULTAS ---
+# Tabelas pequenas lidas em quase todas as páginas (atletas, exercícios, semanas, adversários).
+# Cada tabela tem um contador de versão por DB; os caminhos de escrita chamam bump_tables()
+# e uma entrada só é reutilizada enquanto as versões das tabelas que leu não mudarem.
+# cached_result() usa o mesmo mecanismo para DataFrames calculados a partir dessas tabelas.
+
+class QueryCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.versions = {}  # (db_file, tabela) -> versão
+        self.entries = {}   # (db_file, sql ou nome, params) -> (versões lidas, DataFrame); ordem = LRU
+        self.stats = {}     # nome -> [hits, misses]
+
+    def _versions(self, db_file, tables):
+        return tuple(self.versions.get((db_file, t), 0) for t in tables)
+
+    def read(self, name, tables, sql, params, db_file):
+        def load():
+            conn = get_db_connection(db_file)
+            try:
+                return pd.read_sql_query(sql, conn, params=params)
+            finally:
+                conn.close()
+        return self.get(name, tables, (db_file, sql, tuple(params)), load)
+
+    def get(self, name, tables, key, build):
+        db_file = key[0]
+        with self.lock:
+            # Versões lidas ANTES da consulta: uma escrita a meio invalida a entrada guardada
+            vers = self._versions(db_file, tables)
+            stat = self.stats.setdefault(name, [0, 0])
+            hit = self.entries.pop(key, None)
+            if hit and hit[0] == vers:
+                self.entries[key] = hit
+                stat[0] += 1
+                return hit[1].copy()
+            stat[1] += 1
+        df = build()
+        with self.lock:
+            self.entries[key] = (vers, df)
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        return df.copy()
+
+    def bump(self, db_file, tables):
+        with self.lock:
+            for t in tables:
+                self.versions[(db_file, t)] = self.versions.get((db_file, t), 0) + 1
+
+    def drop_db(self, db_file):
+        """O ficheiro foi substituído (restauro/sincronização): esquecer tudo o que se leu dele."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == db_file]:
+                del self.entries[key]
+
+    def stats_frame(self):
+        with self.lock:
+            rows = [(n, h, m) for n, (h, m) in sorted(self.stats.items())]
+        df = pd.DataFrame(rows, columns=["Consulta", "Hits", "Misses"])
+        df["Hit %"] = (100 * df["Hits"] / (df["Hits"] + df["Misses"]).clip(lower=1)).round(1)
+        return df
+
+@st.cache_resource
+def get_query_cache():
+    return QueryCache(QUERY_CACHE_MAX_ENTRIES)
+
+def cached_query(name, tables, sql, params=(), db_file=None):
+    """pd.read_sql_query memorizado até alguma das `tables` mudar (ver bump_tables)."""
+    return get_query_cache().read(name, tables, sql, params, db_file or current_db_file())
+
+def cached_result(name, tables, params, build, db_file=None):
+    """build() memorizado por (nome, params) até alguma das `tables` mudar."""
+    db_file = db_file or current_db_file()
+    return get_query_cache().get(name, tables, (db_file, name, tuple(params)), build)
+
+def bump_tables(*tables, db_file=None):
+    get_query_cache().bump(db_file or current_db_file(), tables)
+
+# --- ARMAZÉM DE BLOBS ---
+# As tabelas só guardam (hash, tamanho); os bytes vivem uma única vez em BLOB_DB_FILE.
+# No Drive cada blob é um ficheiro "blob_<hash>" enviado uma só vez (coluna uploaded).
+# blob_refs marca que DB usa cada hash; sweep_blobs() apaga (local e Drive) os blobs que nenhuma DB
+# refere há BLOB_GC_GRACE_DAYS. As marcas de DBs que não estão neste servidor nunca expiram.
+
+# (tabela, coluna antiga com os bytes, coluna do hash, coluna do tamanho)
+BLOB_COLUMNS = [
+    ("exercises", "image", "image_hash", "image_size"),
+    ("opponent_files", "content", "content_hash", "content_size"),
+    ("library_files", "content", "content_hash", "content_size"),
+]
+# Um blob sem referências só é apagado passados estes dias (uploads a meio, restauros recentes)
+BLOB_GC_GRACE_DAYS = 7
+
+@st.cache_resource
+def init_blob_store(db_file=BLOB_DB_FILE):
+    conn = get_db_connection(db_file)
+    try:
+        conn.execute("""CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, data BLOB,
+                        created TEXT, uploaded INTEGER DEFAULT 0)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_pending ON blobs(uploaded) WHERE uploaded = 0")
+        conn.execute("""CREATE TABLE IF NOT EXISTS thumbnails (exercise_id INTEGER, image_hash TEXT, data BLOB,
+                        size INTEGER, last_used REAL, PRIMARY KEY (exercise_id, image_hash))""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_thumbnails_lru ON thumbnails(last_used)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS blob_refs (hash TEXT, db TEXT, last_seen TEXT,
+                        PRIMARY KEY (hash, db)) WITHOUT ROWID""")
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def blob_name(h):
+    return f"blob_{h}"
+
+def claim_blobs(conn, hashes, db_file, now):
+    """Marca os hashes como usados por db_file (na ligação ao armazém)."""
+    conn.executemany("""INSERT INTO blob_refs (hash, db, last_seen) VALUES (?,?,?)
+                        ON CONFLICT(hash, db) DO UPDATE SET last_seen=excluded.last_seen""",
+                     [(h, os.path.basename(db_file), now) for h in hashes])
+
+def put_blob(data, db_file=None):
+    """Guarda os bytes no armazém (sem duplicados) e marca-os como usados por db_file. Devolve (hash, tamanho)."""
+    init_blob_store()
+    h = hashlib.sha256(data).hexdigest()
+    now = datetime.now().isoformat(timespec="seconds")
+    conn = get_db_connection(BLOB_DB_FILE)
+    try:
+        cur = conn.execute("INSERT OR IGNORE INTO blobs (hash, size, data, created) VALUES (?,?,?,?)",
+                           (h, len(data), sqlite3.Binary(data), now))
+        is_new = cur.rowcount > 0
+        claim_blobs(conn, [h], db_file or current_db_file(), now)
+        conn.commit()
+    finally:
+        conn.close()
+    if is_new and drive_enabled():
+        get_upload_worker().submit("blob", BLOB_DB_FILE, "novos ficheiros", 1)
+    return h, len(data)
+
+def read_blob_local(h):
+    """Lê o blob em blocos com I/O incremental (blobopen), sem materializar a linha no SELECT."""
+    conn = get_db_connection(BLOB_DB_FILE)
+    try:
+        row = conn.execute("SELECT rowid, size FROM blobs WHERE hash=?", (h,)).fetchone()
+        if not row:
+            return None
+        if not hasattr(conn, "blobopen"):  # Python < 3.11
+            return conn.execute("SELECT data FROM blobs WHERE rowid=?", (row[0],)).fetchone()[0]
+        out = bytearray()
+        with conn.blobopen("blobs", "data", row[0], readonly=True) as b:
+            for chunk in iter(lambda: b.read(BLOB_READ_CHUNK), b""):
+                out += chunk
+        return bytes(out)
+    finally:
+        conn.close()
 
-def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+def get_blob(h):
+    """Bytes de um blob; se não existir localmente (ex.: DB restaurada) vem do Drive."""
+    if not h:
+        return None
+    init_blob_store()
+    data = read_blob_local(h)
+    if data is not None:
+        return data
+    service = get_drive_service()
+    if not service:
+        return None
+    buf = io.BytesIO()
+    if not drive_download_to(service, blob_name(h), buf):
+        return None
+    data = buf.getvalue()
+    if hashlib.sha256(data).hexdigest() != h:
+        return None
+    conn = get_db_connection(BLOB_DB_FILE)
+    try:
+        conn.execute("INSERT OR IGNORE INTO blobs (hash, size, data, created, uploaded) VALUES (?,?,?,?,1)",
+                     (h, len(data), sqlite3.Binary(data), datetime.now().isoformat(timespec="seconds")))
+        conn.commit()
+    finally:
+        conn.close()
+    return data
+
+def fmt_size(n):
+    if pd.isna(n) or not n:
+        return ""
+    return f"{n / 1024:.0f} KB" if n < 1024 * 1024 else f"{n / (1024 * 1024):.1f} MB"
+
+def blob_download_button(label, h, file_name, key):
+    """Só lê os bytes quando o treinador pede o ficheiro; até lá a lista usa apenas metadados."""
+    ready = st.session_state.get('blob_ready')
+    if ready and ready[0] == key:
+        st.download_button(label, ready[1], file_name=file_name, key=f"{key}_get")
+    elif st.button(label, key=key, help="Preparar download"):
+        data = get_blob(h)
+        if data is None:
+            st.error("Ficheiro indisponível (nem local nem no Drive).")
+        else:
+            # Só um ficheiro preparado de cada vez, para não acumular bytes na sessão
+            st.session_state['blob_ready'] = (key, data)
+            st.rerun()
 
-def check_db_updates():
-    """Verifica e cria tabelas/colunas. Versão V62 Completa."""
+def upload_new_blobs(db_file=BLOB_DB_FILE, progress=None):
+    """Envia para o Drive só os blobs ainda não enviados (corre no UploadWorker)."""
+    service = get_drive_service()
+    if not service:
+        raise RuntimeError("Google Drive não configurado")
+    init_blob_store(db_file)
+    conn = get_db_connection(db_file)
+    try:
+        pending = [r[0] for r in conn.execute("SELECT hash FROM blobs WHERE uploaded = 0").fetchall()]
+    finally:
+        conn.close()
+    for i, h in enumerate(pending):
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".blob") as tf:
+                tmp = tf.name
+                conn = get_db_connection(db_file)
+                try:
+                    tf.write(conn.execute("SELECT data FROM blobs WHERE hash=?", (h,)).fetchone()[0])
+                finally:
+                    conn.close()
+            drive_upload_file(service, tmp, blob_name(h))
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.unlink(tmp)
+        conn = get_db_connection(db_file)
+        try:
+            conn.execute("UPDATE blobs SET uploaded = 1 WHERE hash=?", (h,))
+            conn.commit()
+        finally:
+            conn.close()
+        if progress:
+            progress((i + 1) / len(pending))
+
+def move_blobs_to_store(c):
+    """Tira os bytes antigos das tabelas para o armazém. Devolve quantos moveu."""
+    db_file = c.execute("PRAGMA database_list").fetchone()[2]
+    moved = 0
+    for table, col, hash_col, size_col in BLOB_COLUMNS:
+        if col not in table_columns(c, table):
+            continue
+        ids = [r[0] for r in c.execute(f"SELECT id FROM {table} WHERE {col} IS NOT NULL").fetchall()]
+        for row_id in ids:
+            data = c.execute(f"SELECT {col} FROM {table} WHERE id=?", (row_id,)).fetchone()[0]
+            h, size = put_blob(bytes(data), db_file)
+            c.execute(f"UPDATE {table} SET {hash_col}=?, {size_col}=?, {col}=NULL WHERE id=?", (h, size, row_id))
+            moved += 1
+    return moved
+
+def known_db_files():
+    """Todas as DBs que podem referir blobs, estejam ou não neste servidor."""
+    if STORAGE_MODE != "sharded":
+        return [DB_FILE]
+    conn = get_auth_connection()
+    try:
+        users = [r[0] for r in conn.execute("SELECT username FROM users")]
+    finally:
+        conn.close()
+    # A DB única continua a servir os treinadores ainda não separados
+    return [DB_FILE] + [user_db_file(u) for u in users]
+
+def sweep_blobs(progress=None):
+    """Renova as marcas das DBs locais e apaga (local e Drive) os blobs sem marcas. Devolve (nº, bytes)."""
+    init_blob_store()
+    now = datetime.now()
+    now_s = now.isoformat(timespec="seconds")
+    cutoff = (now - timedelta(days=BLOB_GC_GRACE_DAYS)).isoformat(timespec="seconds")
+    known = [os.path.basename(f) for f in known_db_files()]
+    local = [f for f in known_db_files() if os.path.exists(f)]
+    store = get_db_connection(BLOB_DB_FILE)
+    try:
+        for db_file in local:
+            conn = get_db_connection(db_file)
+            try:
+                refs = set()
+                for table, _, hash_col, _ in BLOB_COLUMNS:
+                    if hash_col in table_columns(conn, table):
+                        refs.update(r[0] for r in conn.execute(f"SELECT DISTINCT {hash_col} FROM {table} WHERE {hash_col} IS NOT NULL"))
+            finally:
+                conn.close()
+            claim_blobs(store, refs, db_file, now_s)
+        # Marcas antigas só expiram nas DBs que acabaram de ser vistas (ou em ficheiros que já não são DBs conhecidas)
+        swept = [os.path.basename(f) for f in local]
+        store.execute(f"""DELETE FROM blob_refs WHERE last_seen < ?
+                          AND (db IN ({', '.join('?' * len(swept)) or "''"}) OR db NOT IN ({', '.join('?' * len(known))}))""",
+                      [cutoff] + swept + known)
+        store.commit()
+        orphans = store.execute("""SELECT hash, size, uploaded FROM blobs b WHERE created < ?
+                                   AND NOT EXISTS (SELECT 1 FROM blob_refs r WHERE r.hash = b.hash)""", (cutoff,)).fetchall()
+    finally:
+        store.close()
+    service = get_drive_service() if drive_enabled() else None
+    deleted, freed = 0, 0
+    for i, (h, size, uploaded) in enumerate(orphans):
+        if uploaded:
+            if not service:
+                continue  # fica para quando o Drive estiver disponível
+            drive_delete_file(service, blob_name(h))
+        store = get_db_connection(BLOB_DB_FILE)
+        try:
+            store.execute("DELETE FROM blobs WHERE hash=?", (h,))
+            store.execute("DELETE FROM thumbnails WHERE image_hash=?", (h,))
+            store.commit()
+        finally:
+            store.close()
+        deleted += 1
+        freed += size or 0
+        if progress:
+            progress((i + 1) / len(orphans))
+    return deleted, freed
+
+def schedule_blob_sweep(reason="ficheiros apagados"):
+    """Limpeza de blobs em segundo plano (pedidos repetidos agrupam-se na outbox)."""
+    get_upload_worker().submit("gc", BLOB_DB_FILE, reason)
+
+@st.cache_resource
+def start_blob_maintenance():
+    """Uma limpeza por arranque do processo."""
+    schedule_blob_sweep("manutenção")
+    return True
+
+# --- NORMALIZAÇÃO DE IMAGENS ---
+
+def flatten_rgb(img):
+    """Converte para RGB, pondo a transparência sobre fundo branco."""
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.split()[-1])
+        return bg
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+def normalize_image(data):
+    """Roda pela orientação EXIF, reduz a IMAGE_MAX_SIDE e recodifica sem metadados.
+    Se o ficheiro não for uma imagem válida, devolve os bytes originais."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG: descodificar já reduzido (muito mais rápido em fotos de telemóvel)
+        img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        fmt = IMAGE_FORMAT if IMAGE_FORMAT != "WEBP" or features.check("webp") else "JPEG"
+        if fmt == "WEBP" and img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if img.mode in ("LA", "P", "PA") else "RGB")
+        elif fmt == "JPEG":
+            img = flatten_rgb(img)
+        opts = {"method": 4} if fmt == "WEBP" else {"optimize": True}
+        out = io.BytesIO()
+        # Sem exif=/icc_profile=: o ficheiro gravado não leva metadados (GPS, câmara, ...)
+        img.save(out, format=fmt, quality=IMAGE_QUALITY, **opts)
+        return out.getvalue()
+    except Exception:
+        return data
+
+# --- MINIATURAS ---
+# Chave (exercício, hash da imagem): trocar a imagem gera outra chave e a antiga sai por LRU.
+
+def make_thumbnail(data):
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+    img = flatten_rgb(ImageOps.exif_transpose(img))
+    img.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=80, optimize=True)
+    return out.getvalue()
+
+def evict_thumbnails(conn):
+    """Apaga as miniaturas menos usadas até a cache caber em THUMB_CACHE_MAX_BYTES."""
+    total = conn.execute("SELECT coalesce(sum(size), 0) FROM thumbnails").fetchone()[0]
+    if total <= THUMB_CACHE_MAX_BYTES:
+        return
+    for ex_id, h, size in conn.execute("SELECT exercise_id, image_hash, size FROM thumbnails ORDER BY last_used").fetchall():
+        conn.execute("DELETE FROM thumbnails WHERE exercise_id=? AND image_hash=?", (ex_id, h))
+        total -= size
+        if total <= THUMB_CACHE_MAX_BYTES:
+            break
+
+def get_thumbnail(exercise_id, h):
+    """Miniatura da imagem do exercício; gerada no upload ou na 1ª visualização."""
+    if not h:
+        return None
+    init_blob_store()
+    now = datetime.now().timestamp()
+    conn = get_db_connection(BLOB_DB_FILE)
+    try:
+        row = conn.execute("SELECT data, last_used FROM thumbnails WHERE exercise_id=? AND image_hash=?",
+                           (int(exercise_id), h)).fetchone()
+        if row:
+            # Atualizar o LRU no máximo uma vez por minuto, para os reruns não escreverem sempre
+            if now - row[1] > 60:
+                conn.execute("UPDATE thumbnails SET last_used=? WHERE exercise_id=? AND image_hash=?", (now, int(exercise_id), h))
+                conn.commit()
+            return row[0]
+    finally:
+        conn.close()
+    data = get_blob(h)
+    if data is None:
+        return None
+    try:
+        thumb = make_thumbnail(data)
+    except Exception:
+        return None
+    conn = get_db_connection(BLOB_DB_FILE)
+    try:
+        conn.execute("INSERT OR REPLACE INTO thumbnails (exercise_id, image_hash, data, size, last_used) VALUES (?,?,?,?,?)",
+                     (int(exercise_id), h, sqlite3.Binary(thumb), len(thumb), now))
+        evict_thumbnails(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return thumb
+
+# --- RESUMO DE KPIs DO DASHBOARD ---
+# match_kpis guarda, por treinador, os totais que o Dashboard mostra. Os caminhos de escrita
+# do Centro de Jogo aplicam só a diferença (linhas removidas/adicionadas) na mesma transação.
+
+MATCH_FORM_GAMES = 5
+
+def match_kpi_rows(c, where, params):
+    """(golos sofridos, defesas) das linhas de matches que uma escrita vai tocar."""
+    return c.execute(f"SELECT goals_conceded, saves FROM matches WHERE {where}", params).fetchall()
+
+def refresh_match_form(c, user):
+    # Forma = últimas linhas por data (usa idx_matches_user_date_opp)
+    form = c.execute("SELECT date, opponent, goals_conceded FROM matches WHERE user_id=? ORDER BY date DESC LIMIT ?",
+                     (user, MATCH_FORM_GAMES)).fetchall()
+    c.execute("UPDATE match_kpis SET form=?, updated=? WHERE user_id=?",
+              (json.dumps(form), datetime.now().isoformat(timespec="seconds"), user))
+
+def update_match_kpis(c, user, removed=(), added=()):
+    """Aplica ao resumo a diferença entre as linhas removidas e as adicionadas."""
+    def totals(rows):
+        # Valores vindos do pandas podem ser NaN em vez de None
+        rows = [(None if g is None or g != g else int(g), 0 if s is None or s != s else int(s)) for g, s in rows]
+        return (len(rows), sum(1 for g, _ in rows if g == 0), sum(g or 0 for g, _ in rows), sum(s for _, s in rows))
+    add, rem = totals(added), totals(removed)
+    d_games, d_cs, d_goals, d_saves = (a - r for a, r in zip(add, rem))
+    c.execute("INSERT OR IGNORE INTO match_kpis (user_id) VALUES (?)", (user,))
+    c.execute("""UPDATE match_kpis SET games = games + ?, clean_sheets = clean_sheets + ?,
+                 goals_conceded = goals_conceded + ?, saves = saves + ? WHERE user_id=?""",
+              (d_games, d_cs, d_goals, d_saves, user))
+    refresh_match_form(c, user)
+
+def rebuild_match_kpis(c, user=None):
+    """Recalcula o resumo a partir de matches (todos os treinadores se user=None).
+    Devolve os treinadores cujo resumo guardado estava diferente."""
+    where, params = ("WHERE user_id=?", (user,)) if user else ("", ())
+    before = {r[0]: tuple(r[1:]) for r in c.execute(f"SELECT user_id, games, clean_sheets, goals_conceded, saves FROM match_kpis {where}", params)}
+    fresh = c.execute(f"""SELECT user_id, count(*), coalesce(sum(goals_conceded = 0), 0), coalesce(sum(goals_conceded), 0), coalesce(sum(saves), 0)
+                          FROM matches {where} GROUP BY user_id""", params).fetchall()
+    c.execute(f"DELETE FROM match_kpis {where}", params)
+    c.executemany("INSERT INTO match_kpis (user_id, games, clean_sheets, goals_conceded, saves) VALUES (?,?,?,?,?)", fresh)
+    for r in fresh:
+        refresh_match_form(c, r[0])
+    after = {r[0]: tuple(r[1:]) for r in fresh}
+    return sorted(u for u in set(before) | set(after) if before.get(u) != after.get(u))
+
+def read_match_kpis(user):
+    """A linha do Dashboard: (jogos, clean sheets, golos sofridos, defesas, forma)."""
     conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT games, clean_sheets, goals_conceded, saves, form FROM match_kpis WHERE user_id=?", (user,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return 0, 0, 0, 0, []
+    return row[0], row[1], row[2], row[3], json.loads(row[4] or "[]")
+
+# --- TENDÊNCIAS DAS AVALIAÇÕES DE TREINO ---
+# rating_trends guarda, por atleta, (n, soma, soma dos quadrados) das notas em baldes:
+# semana (segunda-feira), microciclo (id) e 'all'. Gravar uma nota só aplica a diferença aos
+# seus três baldes; médias e variâncias saem das somas sem reler o histórico.
+
+# Janelas móveis (dias) mostradas na Evolução
+RATING_WINDOWS = (7, 28)
+# Acima disto o gráfico passa de semanas para meses
+TREND_MAX_POINTS = 104
+# Média móvel do gráfico, em baldes (4 semanas ~ 28 dias)
+RATING_ROLLING_BUCKETS = 4
+
+def rating_trend_keys(c, user, date_s):
+    """Baldes (period, period_key) de uma nota do dia date_s."""
+    d = datetime.strptime(date_s, "%Y-%m-%d")
+    keys = [("all", ""), ("week", (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d"))]
+    micro = c.execute("""SELECT id FROM microcycles WHERE user_id=? AND start_date <= ? AND date(start_date, '+6 days') >= ?
+                         ORDER BY start_date DESC LIMIT 1""", (user, date_s, date_s)).fetchone()
+    if micro:
+        keys.append(("micro", str(micro[0])))
+    return keys
+
+def update_rating_trend(c, user, gk_id, date_s, old=None, new=None):
+    """Aplica a troca de nota old -> new (None = não existia / foi apagada) aos baldes do dia."""
+    dn = (new is not None) - (old is not None)
+    ds = (new or 0) - (old or 0)
+    dq = (new or 0) ** 2 - (old or 0) ** 2
+    if not (dn or ds or dq):
+        return
+    c.executemany("""INSERT INTO rating_trends (user_id, gk_id, period, period_key, n, total, total_sq) VALUES (?,?,?,?,?,?,?)
+                     ON CONFLICT(user_id, gk_id, period, period_key) DO UPDATE SET
+                     n = n + excluded.n, total = total + excluded.total, total_sq = total_sq + excluded.total_sq""",
+                  [(user, gk_id, p, k, dn, ds, dq) for p, k in rating_trend_keys(c, user, date_s)])
+
+def rebuild_rating_trends(c, user=None):
+    """Recalcula os baldes a partir de training_ratings (p.ex. quando as datas dos microciclos mudam)."""
+    where, params = ("WHERE tr.user_id=?", (user,)) if user else ("", ())
+    c.execute(f"DELETE FROM rating_trends {'WHERE user_id=?' if user else ''}", params)
+    c.execute(f"""INSERT INTO rating_trends (user_id, gk_id, period, period_key, n, total, total_sq)
+                  SELECT user_id, gk_id, period, period_key, count(*), sum(rating), sum(rating * rating) FROM (
+                      SELECT tr.user_id, tr.gk_id, tr.rating, 'all' AS period, '' AS period_key FROM training_ratings tr {where}
+                      UNION ALL
+                      SELECT tr.user_id, tr.gk_id, tr.rating, 'week', date(tr.date, 'weekday 0', '-6 days') FROM training_ratings tr {where}
+                      UNION ALL
+                      SELECT tr.user_id, tr.gk_id, tr.rating, 'micro',
+                             (SELECT CAST(m.id AS TEXT) FROM microcycles m WHERE m.user_id = tr.user_id AND m.start_date <= tr.date
+                              AND date(m.start_date, '+6 days') >= tr.date ORDER BY m.start_date DESC LIMIT 1)
+                      FROM training_ratings tr {where}
+                  ) WHERE period_key IS NOT NULL AND rating IS NOT NULL GROUP BY user_id, gk_id, period, period_key""", params * 3)
+
+def add_trend_stats(df):
+    """Colunas mean/std (desvio-padrão amostral) a partir de n, total e total_sq."""
+    n = df["n"].where(df["n"] > 0)
+    df["mean"] = df["total"] / n
+    df["std"] = ((df["total_sq"] - df["total"] ** 2 / n) / (n - 1).where(n > 1)).clip(lower=0) ** 0.5
+    return df
+
+def rating_windows(conn, gk_id, today):
+    """Média/desvio das janelas RATING_WINDOWS até `today`: leitura pelo índice (gk_id, date), no máximo 28 notas."""
+    rows = []
+    for days in RATING_WINDOWS:
+        start = (today - timedelta(days=days)).strftime("%Y-%m-%d")
+        n, total, total_sq = conn.execute("""SELECT count(rating), coalesce(sum(rating), 0), coalesce(sum(rating * rating), 0)
+                                             FROM training_ratings WHERE gk_id=? AND date > ? AND date <= ?""",
+                                          (gk_id, start, today.strftime("%Y-%m-%d"))).fetchone()
+        rows.append((days, n, total, total_sq))
+    return add_trend_stats(pd.DataFrame(rows, columns=["days", "n", "total", "total_sq"]).set_index("days"))
+
+def rating_trend_series(user, gk_id, max_points=TREND_MAX_POINTS):
+    """Série para o gráfico a partir dos baldes semanais; meses se houver mais de max_points semanas.
+    Devolve (DataFrame indexado pelo início do balde, "semana"/"mês")."""
+    df = cached_query("rating_trends_week", ("rating_trends",),
+                      """SELECT period_key AS start, n, total, total_sq FROM rating_trends
+                         WHERE user_id=? AND gk_id=? AND period='week' ORDER BY period_key""", (user, gk_id))
+    bucket = "semana"
+    if len(df) > max_points:
+        # Somas exatas: a média e a variância mensais continuam certas
+        df = df.groupby(df["start"].str[:7] + "-01")[["n", "total", "total_sq"]].sum().rename_axis("start").reset_index()
+        bucket = "mês"
+    rolled = df[["n", "total"]].rolling(RATING_ROLLING_BUCKETS, min_periods=1).sum()
+    df["rolling"] = rolled["total"] / rolled["n"]
+    return add_trend_stats(df).set_index("start"), bucket
+
+def rating_micro_trends(user, gk_id):
+    df = cached_query("rating_trends_micro", ("rating_trends", "microcycles"),
+                      """SELECT m.title, m.start_date, t.n, t.total, t.total_sq FROM rating_trends t
+                         JOIN microcycles m ON m.id = CAST(t.period_key AS INTEGER)
+                         WHERE t.user_id=? AND t.gk_id=? AND t.period='micro' ORDER BY m.start_date""", (user, gk_id))
+    return add_trend_stats(df)
+
+# --- PERSISTÊNCIA DE JOGOS ---
+# Cabeçalho do jogo em `games` (id inteiro, data, adversário, resultado, tipo);
+# cada linha de `matches` é a ficha de um guarda-redes e aponta para o jogo por match_id.
+# date/opponent/result/match_type continuam copiados em matches para as leituras existentes.
+
+# Sessão 'Jogo' do calendário no dia de cada jogo, resolvida na leitura: mudar o tipo ou a data
+# da sessão no planeador reflete-se logo, sem nada a religar (usa idx_sessions_user_date)
+GAME_SESSION_SQL = """(SELECT s.title FROM sessions s WHERE s.user_id = g.user_id AND s.start_date = g.date
+                       AND s.type = 'Jogo' ORDER BY s.id LIMIT 1)"""
+
+# Ações técnicas por guarda-redes, pela ordem do formulário
+MATCH_TECH_COLUMNS = [
+    "db_bloq_sq_rast", "db_bloq_sq_med", "db_bloq_sq_alt", "db_bloq_cq_rast", "db_bloq_cq_med", "db_bloq_cq_alt",
+    "db_rec_sq_med", "db_rec_sq_alt", "db_rec_cq_rast", "db_rec_cq_med", "db_rec_cq_alt", "db_rec_cq_varr",
+    "db_desv_sq_pe", "db_desv_sq_mfr", "db_desv_sq_mlat", "db_desv_sq_a1", "db_desv_sq_a2",
+    "db_desv_cq_varr", "db_desv_cq_r1", "db_desv_cq_r2", "db_desv_cq_a1", "db_desv_cq_a2",
+    "db_ext_rec", "db_ext_desv_1", "db_ext_desv_2", "db_voo_rec", "db_voo_desv_1", "db_voo_desv_2", "db_voo_desv_mc",
+    "de_cabeca", "de_carrinho", "de_alivio", "de_rececao",
+    "duelo_parede", "duelo_abafo", "duelo_estrela", "duelo_frontal",
+    "pa_curto_1", "pa_curto_2", "pa_longo_1", "pa_longo_2",
+    "dist_curta_mao", "dist_longa_mao", "dist_picada_mao", "dist_volley", "dist_curta_pe", "dist_longa_pe",
+    "cruz_rec_alta", "cruz_soco_1", "cruz_soco_2", "cruz_int_rast",
+    "eto_pb_curto", "eto_pb_medio", "eto_pb_longo",
+]
+# Colunas guardadas na própria linha de matches; as técnicas vão para match_actions
+MATCH_STAT_COLUMNS = ["goals_conceded", "saves", "report", "rating", "match_duration", "shots_faced", "shots_off_target",
+                      "psy_comm", "psy_decision", "psy_posture", "psy_resilience"]
+# Colunas de cada linha (guarda-redes) e do jogo (iguais em todas as linhas)
+MATCH_LINE_COLUMNS = MATCH_STAT_COLUMNS + MATCH_TECH_COLUMNS
+MATCH_GAME_COLUMNS = ["result", "match_type"]
+# Chaves do formulário "Registrar Jogo", paralelas a MATCH_LINE_COLUMNS
+MATCH_FORM_KEYS = ["gls", "sav", "rep", "rat", "min", "sh_faced", "sh_off", "psy_comm", "psy_dec", "psy_pos", "psy_res",
+                   "b_sq_r", "b_sq_m", "b_sq_a", "b_cq_r", "b_cq_m", "b_cq_a",
+                   "r_sq_m", "r_sq_a", "r_cq_r", "r_cq_m", "r_cq_a", "r_cq_v",
+                   "d_sq_p", "d_sq_mf", "d_sq_ml", "d_sq_a1", "d_sq_a2", "d_cq_v", "d_cq_r1", "d_cq_r2", "d_cq_a1", "d_cq_a2",
+                   "e_rec", "e_d1", "e_d2", "v_rec", "v_d1", "v_d2", "v_dmc",
+                   "de_cab", "de_car", "de_ali", "de_rec", "du_par", "du_aba", "du_est", "du_fro",
+                   "pa_c1", "pa_c2", "pa_l1", "pa_l2", "di_cm", "di_lm", "di_pm", "di_vo", "di_cp", "di_lp",
+                   "cr_rec", "cr_s1", "cr_s2", "cr_int", "eto_cur", "eto_med", "eto_lon"]
+
+def _same_value(a, b):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return float(a) == float(b)
+    return a == b
+
+# --- AÇÕES TÉCNICAS (FORMATO LONGO) ---
+# match_actions guarda só as contagens > 0 de cada ficha: (line_id, code, count).
+# action_catalog dá a família de cada código; uma ação nova é só mais um código aqui + um passo de migração
+# que chame seed_action_catalog (sem ALTER TABLE em matches).
+
+# (família, rótulo, prefixos dos códigos), pela ordem dos gráficos
+ACTION_FAMILIES = [
+    ("bloqueios", "Bloqueios", ("db_bloq_",)),
+    ("rececoes", "Receções", ("db_rec_",)),
+    ("desvios", "Desvios", ("db_desv_",)),
+    ("quedas", "Extensões e Voos", ("db_ext_", "db_voo_")),
+    ("espaco", "Defesa do Espaço", ("de_",)),
+    ("duelos", "1x1", ("duelo_",)),
+    ("distribuicao", "Distribuição", ("pa_", "dist_")),
+    ("cruzamentos", "Cruzamentos", ("cruz_",)),
+    ("bolas_paradas", "Esquemas Táticos", ("eto_",)),
+]
+ACTION_FAMILY_LABELS = {f: label for f, label, _ in ACTION_FAMILIES}
+
+def action_family(code):
+    return next(f for f, _, prefixes in ACTION_FAMILIES if code.startswith(prefixes))
+
+def seed_action_catalog(c):
+    c.executemany("""INSERT INTO action_catalog (code, family, position) VALUES (?,?,?)
+                     ON CONFLICT(code) DO UPDATE SET family=excluded.family, position=excluded.position""",
+                  [(code, action_family(code), i) for i, code in enumerate(MATCH_TECH_COLUMNS)])
+
+def read_line_actions(c, line_ids):
+    """{line_id: {code: count}} só com as contagens gravadas."""
+    out = {i: {} for i in line_ids}
+    if out:
+        marks = ", ".join("?" * len(out))
+        for line_id, code, count in c.execute(f"SELECT line_id, code, count FROM match_actions WHERE line_id IN ({marks})", list(out)):
+            out[line_id][code] = count
+    return out
+
+def write_line_actions(c, line_id, actions):
+    """Grava {code: count} de uma ficha; 0/None apaga o código."""
+    keep = [(line_id, code, int(n)) for code, n in actions.items() if n]
+    drop = [(line_id, code) for code, n in actions.items() if not n]
+    if keep:
+        c.executemany("""INSERT INTO match_actions (line_id, code, count) VALUES (?,?,?)
+                         ON CONFLICT(line_id, code) DO UPDATE SET count=excluded.count""", keep)
+    if drop:
+        c.executemany("DELETE FROM match_actions WHERE line_id=? AND code=?", drop)
+
+def match_lines_frame(conn, match_id):
+    """Fichas de um jogo com as ações técnicas de volta em colunas (0 onde não há registo)."""
+    rows = pd.read_sql_query("SELECT * FROM matches WHERE match_id=?", conn, params=(match_id,))
+    acts = pd.read_sql_query("""SELECT x.line_id, x.code, x.count FROM match_actions x JOIN matches m ON m.id = x.line_id
+                                WHERE m.match_id=?""", conn, params=(match_id,))
+    wide = acts.pivot(index="line_id", columns="code", values="count").reindex(columns=MATCH_TECH_COLUMNS)
+    rows = rows.join(wide, on="id")
+    rows[MATCH_TECH_COLUMNS] = rows[MATCH_TECH_COLUMNS].fillna(0).astype(int)
+    return rows
+
+def action_family_totals(user, match_id=None):
+    """Totais por (gk_id, família) com um GROUP BY; tabela gk_id x família pela ordem de ACTION_FAMILIES."""
+    where, params = "m.user_id=?", (user,)
+    if match_id is not None:
+        where, params = "m.user_id=? AND m.match_id=?", (user, match_id)
+    df = cached_query("action_family_totals", ("matches", "match_actions"),
+                      f"""SELECT m.gk_id, a.family, SUM(x.count) AS total FROM match_actions x
+                          JOIN matches m ON m.id = x.line_id JOIN action_catalog a ON a.code = x.code
+                          WHERE {where} GROUP BY m.gk_id, a.family""", params)
+    families = [f for f, _, _ in ACTION_FAMILIES]
+    return df.pivot(index="gk_id", columns="family", values="total").reindex(columns=families).fillna(0).astype(int)
+
+# --- ANÁLISE DE DESEMPENHO (JOGOS) ---
+# Uma passagem vetorizada sobre todas as fichas do treinador, agregada por (gk_id, época):
+# taxas por 90', % de defesas (sobre shots_faced), distribuição por família e médias psicológicas.
+
+# A época começa em julho: 2025/26 = jul/2025 a jun/2026
+SEASON_START_MONTH = 7
+PSY_COLUMNS = {"psy_comm": "Comunicação", "psy_decision": "Tomada de Decisão",
+               "psy_posture": "Postura", "psy_resilience": "Resiliência"}
+
+def season_labels(dates):
+    """Datas 'AAAA-MM-DD' -> épocas 'AAAA/AA'."""
+    d = pd.to_datetime(dates)
+    start = d.dt.year - (d.dt.month < SEASON_START_MONTH).astype(int)
+    return start.astype(str) + "/" + ((start + 1) % 100).astype(str).str.zfill(2)
+
+def build_match_analytics(lines, actions):
+    """lines: uma linha por ficha; actions: (line_id, family, total). Devolve um DataFrame indexado por (gk_id, season)."""
+    families = [f for f, _, _ in ACTION_FAMILIES]
+    fam = actions.pivot(index="line_id", columns="family", values="total").reindex(columns=families)
+    df = lines.join(fam, on="id")
+    df[families] = df[families].fillna(0)
+    df["season"] = season_labels(df["date"])
+    df["match_duration"] = df["match_duration"].fillna(90)
+    g = df.groupby(["gk_id", "season"])
+    out = g[["match_duration", "goals_conceded", "saves", "shots_faced"] + families].sum()
+    out.insert(0, "games", g.size())
+    out = out.join(g[["rating"] + list(PSY_COLUMNS)].mean())
+    per90 = out[families + ["goals_conceded", "saves"]].div(out["match_duration"].clip(lower=1), axis=0) * 90
+    out = out.join(per90.add_suffix("_p90"))
+    out["save_pct"] = 100 * out["saves"] / out["shots_faced"].where(out["shots_faced"] > 0)
+    total = out[families].sum(axis=1)
+    out = out.join((100 * out[families].div(total.where(total > 0), axis=0)).add_suffix("_pct"))
+    return out
+
+def match_analytics(user, db_file=None):
+    """build_match_analytics() sobre as fichas do treinador, memorizado até matches/match_actions mudarem."""
+    db_file = db_file or current_db_file()
+    def build():
+        conn = get_db_connection(db_file)
+        try:
+            lines = pd.read_sql_query(f"""SELECT id, gk_id, date, match_duration, goals_conceded, saves, shots_faced, rating,
+                                          {', '.join(PSY_COLUMNS)} FROM matches WHERE user_id=?""", conn, params=(user,))
+            actions = pd.read_sql_query("""SELECT x.line_id, a.family, SUM(x.count) AS total FROM match_actions x
+                                           JOIN matches m ON m.id = x.line_id JOIN action_catalog a ON a.code = x.code
+                                           WHERE m.user_id=? GROUP BY x.line_id, a.family""", conn, params=(user,))
+        finally:
+            conn.close()
+        return build_match_analytics(lines, actions)
+    return cached_result("match_analytics", ("matches", "match_actions"), (user,), build, db_file)
+
+# Estatísticas comparadas entre os guarda-redes do treinador, por época
+PERCENTILE_STATS = {**{f"{f}_p90": f"{label} / 90'" for f, label, _ in ACTION_FAMILIES},
+                    "saves_p90": "Defesas / 90'", "goals_conceded_p90": "Golos / 90'",
+                    "save_pct": "% Defesas", "rating": "Nota Média", **PSY_COLUMNS}
+# Menos é melhor: o percentil é invertido
+PERCENTILE_LOWER_BETTER = {"goals_conceded_p90"}
+
+def build_match_percentiles(ana):
+    """Percentil (0-100) de cada estatística dentro da época, por (gk_id, season)."""
+    by_season = ana[list(PERCENTILE_STATS)].groupby(level="season")
+    pct = by_season.rank(pct=True, method="max") * 100
+    for col in PERCENTILE_LOWER_BETTER:
+        pct[col] = by_season[col].rank(pct=True, method="max", ascending=False) * 100
+    return pct.round(0)
+
+def match_percentiles(user, db_file=None):
+    """Tabela de percentis do plantel; só se recalcula quando matches/match_actions mudam."""
+    return cached_result("match_percentiles", ("matches", "match_actions"), (user,),
+                         lambda: build_match_percentiles(match_analytics(user, db_file)), db_file)
+
+def upsert_game(c, user, header):
+    """Cria ou atualiza o cabeçalho (user, data, adversário) e devolve o seu id."""
+    c.execute("""INSERT INTO games (user_id, date, opponent, result, match_type) VALUES (?,?,?,?,?)
+                 ON CONFLICT(user_id, date, opponent) DO UPDATE SET
+                 result=excluded.result, match_type=excluded.match_type""",
+              (user, header['date'], header['opponent'], header.get('result'), header.get('match_type')))
+    return c.execute("SELECT id FROM games WHERE user_id=? AND date=? AND opponent=?",
+                     (user, header['date'], header['opponent'])).fetchone()[0]
+
+def save_match(conn, user, lines, header=None, match_id=None, replace=True):
+    """Grava as linhas {gk_id: {coluna: valor}} de um jogo numa só transação.
+    header: {date, opponent, result, match_type} para criar/atualizar o jogo; ou match_id de um jogo existente.
+    replace: apaga os guarda-redes do jogo que não vêm em `lines`.
+    Devolve {"match_id": id, "inserted": [...], "updated": [...], "deleted": [...], "unchanged": [...]} com gk_ids."""
     c = conn.cursor()
+    if not conn.in_transaction:
+        c.execute("BEGIN IMMEDIATE")
     try:
-        # --- TABELAS BASE ---
-        c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS goalkeepers (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT, age INTEGER, status TEXT, notes TEXT, height REAL, wingspan REAL, arm_len_left REAL, arm_len_right REAL, glove_size TEXT, jump_front_2 REAL, jump_front_l REAL, jump_front_r REAL, jump_lat_l REAL, jump_lat_r REAL, test_res TEXT, test_agil TEXT, test_vel TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS exercises (id INTEGER PRIMARY KEY, user_id TEXT, title TEXT, moment TEXT, training_type TEXT, description TEXT, objective TEXT, materials TEXT, space TEXT, image BLOB)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, user_id TEXT, type TEXT, title TEXT, start_date TEXT, drills_list TEXT, report TEXT, status TEXT, opponent TEXT, match_time TEXT, location TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS microcycles (id INTEGER PRIMARY KEY, user_id TEXT, title TEXT, start_date TEXT, goal TEXT, report TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS training_ratings (id INTEGER PRIMARY KEY, user_id TEXT, date TEXT, gk_id INTEGER, rating INTEGER, notes TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS attendance (id INTEGER PRIMARY KEY, session_id INTEGER, gk_id INTEGER, status TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS injuries (id INTEGER PRIMARY KEY, gk_id INTEGER, injury_date TEXT, recovery_weeks INTEGER, description TEXT, active INTEGER)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS opponents (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT, notes TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS opponent_files (id INTEGER PRIMARY KEY, opponent_id INTEGER, name TEXT, type TEXT, content BLOB, link TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS library_folders (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS library_files (id INTEGER PRIMARY KEY, folder_id INTEGER, name TEXT, type TEXT, content BLOB, link TEXT, description TEXT)''')
-        
-        # --- TABELA MATCHES COMPLETA (V62) ---
-        c.execute('''CREATE TABLE IF NOT EXISTS matches (
-                        id INTEGER PRIMARY KEY, user_id TEXT, date TEXT, opponent TEXT, gk_id INTEGER, goals_conceded INTEGER, saves INTEGER, result TEXT, report TEXT, rating INTEGER, match_type TEXT,
-                        
-                        -- Colunas Tempo e Subs
-                        match_duration INTEGER DEFAULT 90, 
-                        sub_gk_id INTEGER, 
-                        sub_minute INTEGER, 
-                        sub2_gk_id INTEGER, 
-                        sub2_minute INTEGER,
-                        
-                        -- Colunas Remates e Psicologia
-                        shots_faced INTEGER, 
-                        shots_off_target INTEGER, 
-                        psy_comm INTEGER, 
-                        psy_decision INTEGER, 
-                        psy_posture INTEGER, 
-                        psy_resilience INTEGER,
-                        
-                        -- Estatísticas Técnicas (72 Variáveis)
-                        db_bloq_sq_rast INTEGER, db_bloq_sq_med INTEGER, db_bloq_sq_alt INTEGER, db_bloq_cq_rast INTEGER, db_bloq_cq_med INTEGER, db_bloq_cq_alt INTEGER, 
-                        db_rec_sq_med INTEGER, db_rec_sq_alt INTEGER, db_rec_cq_rast INTEGER, db_rec_cq_med INTEGER, db_rec_cq_alt INTEGER, db_rec_cq_varr INTEGER, 
-                        db_desv_sq_pe INTEGER, db_desv_sq_mfr INTEGER, db_desv_sq_mlat INTEGER, db_desv_sq_a1 INTEGER, db_desv_sq_a2 INTEGER, db_desv_cq_varr INTEGER, db_desv_cq_r1 INTEGER, db_desv_cq_r2 INTEGER, db_desv_cq_a1 INTEGER, db_desv_cq_a2 INTEGER, 
-                        db_ext_rec INTEGER, db_ext_desv_1 INTEGER, db_ext_desv_2 INTEGER, db_voo_rec INTEGER, db_voo_desv_1 INTEGER, db_voo_desv_2 INTEGER, db_voo_desv_mc INTEGER, 
-                        de_cabeca INTEGER, de_carrinho INTEGER, de_alivio INTEGER, de_rececao INTEGER, 
-                        duelo_parede INTEGER, duelo_abafo INTEGER, duelo_estrela INTEGER, duelo_frontal INTEGER, 
-                        pa_curto_1 INTEGER, pa_curto_2 INTEGER, pa_longo_1 INTEGER, pa_longo_2 INTEGER, dist_curta_mao INTEGER, dist_longa_mao INTEGER, dist_picada_mao INTEGER, dist_volley INTEGER, dist_curta_pe INTEGER, dist_longa_pe INTEGER, 
-                        cruz_rec_alta INTEGER, cruz_soco_1 INTEGER, cruz_soco_2 INTEGER, cruz_int_rast INTEGER,
-                        eto_pb_curto INTEGER, eto_pb_medio INTEGER, eto_pb_longo INTEGER)''')
-
-        # --- MIGRAÇÕES (GARANTIR COLUNAS EM DBS ANTIGAS) ---
-        new_cols = [
-            ("sessions", "match_time", "TEXT"), 
-            ("matches", "match_duration", "INTEGER DEFAULT 90"),
-            ("matches", "sub_gk_id", "INTEGER"), 
-            ("matches", "sub_minute", "INTEGER"),
-            ("matches", "sub2_gk_id", "INTEGER"), 
-            ("matches", "sub2_minute", "INTEGER"),
-            ("matches", "shots_faced", "INTEGER"), 
-            ("matches", "shots_off_target", "INTEGER"),
-            ("matches", "psy_comm", "INTEGER"), 
-            ("matches", "psy_decision", "INTEGER"),
-            ("matches", "psy_posture", "INTEGER"), 
-            ("matches", "psy_resilience", "INTEGER")
-        ]
-        for t, c_n, tp in new_cols:
-            try: 
-                c.execute(f"ALTER TABLE {t} ADD COLUMN {c_n} {tp}")
-            except: 
-                pass
-            
+        if header is not None:
+            match_id = upsert_game(c, user, header)
+        g = c.execute("SELECT date, opponent, result, match_type FROM games WHERE id=? AND user_id=?", (match_id, user)).fetchone()
+        game = dict(zip(["date", "opponent", "result", "match_type"], g))
+        cols = [col for col in MATCH_STAT_COLUMNS if any(col in line for line in lines.values())] + ["date", "opponent"] + MATCH_GAME_COLUMNS
+        cur = c.execute(f"SELECT gk_id, id, {', '.join(cols)} FROM matches WHERE match_id=?", (match_id,))
+        names = [d[0] for d in cur.description]
+        old = {r[0]: dict(zip(names, r)) for r in cur.fetchall()}
+        old_actions = read_line_actions(c, [prev["id"] for prev in old.values()])
+        changes = {"match_id": match_id, "inserted": [], "updated": [], "deleted": [], "unchanged": []}
+        upserts, action_diffs, removed, added = [], {}, [], []
+        for gk_id, line in lines.items():
+            new = {**{col: v for col, v in line.items() if col in MATCH_STAT_COLUMNS}, **game}
+            prev = old.get(gk_id)
+            prev_actions = old_actions[prev["id"]] if prev is not None else {}
+            action_diffs[gk_id] = {code: n or 0 for code, n in line.items()
+                                   if code in MATCH_TECH_COLUMNS and (n or 0) != prev_actions.get(code, 0)}
+            if prev is not None and not action_diffs[gk_id] and all(_same_value(prev[col], new[col]) for col in new):
+                changes["unchanged"].append(gk_id)
+                continue
+            changes["updated" if prev is not None else "inserted"].append(gk_id)
+            upserts.append((match_id, user, gk_id) + tuple(new.get(col, prev.get(col) if prev else None) for col in cols))
+            if prev is not None:
+                removed.append((prev.get("goals_conceded"), prev.get("saves")))
+            added.append((new.get("goals_conceded", prev.get("goals_conceded") if prev else None),
+                          new.get("saves", prev.get("saves") if prev else None)))
+        if upserts:
+            c.executemany(f"""INSERT INTO matches (match_id, user_id, gk_id, {', '.join(cols)})
+                              VALUES ({', '.join('?' * (3 + len(cols)))})
+                              ON CONFLICT(match_id, gk_id) DO UPDATE SET
+                              {', '.join(f'{col}=excluded.{col}' for col in cols)}""", upserts)
+            line_ids = dict(c.execute("SELECT gk_id, id FROM matches WHERE match_id=?", (match_id,)).fetchall())
+            for gk_id in changes["inserted"] + changes["updated"]:
+                write_line_actions(c, line_ids[gk_id], action_diffs[gk_id])
+        if replace:
+            gone = [gk_id for gk_id in old if gk_id not in lines]
+            if gone:
+                c.executemany("DELETE FROM matches WHERE match_id=? AND gk_id=?", [(match_id, g) for g in gone])
+                removed += [(old[g].get("goals_conceded"), old[g].get("saves")) for g in gone]
+                changes["deleted"] = gone
+        if upserts or changes["deleted"]:
+            update_match_kpis(c, user, removed=removed, added=added)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return changes
+
+def update_match_header(conn, user, match_id, date_s, opponent, result):
+    """Muda data/adversário/resultado de um jogo (por id). Levanta IntegrityError se já existir outro igual."""
+    c = conn.cursor()
+    try:
+        c.execute("UPDATE games SET date=?, opponent=?, result=? WHERE id=? AND user_id=?",
+                  (date_s, opponent, result, match_id, user))
+        c.execute("UPDATE matches SET date=?, opponent=?, result=? WHERE match_id=?", (date_s, opponent, result, match_id))
+        update_match_kpis(c, user)  # totais iguais, mas a forma depende da data/adversário
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def delete_match_line(conn, user, line_id):
+    """Tira um guarda-redes do jogo; o jogo desaparece quando fica sem fichas."""
+    c = conn.cursor()
+    row = c.execute("SELECT match_id, goals_conceded, saves FROM matches WHERE id=?", (line_id,)).fetchone()
+    if not row:
+        return
+    c.execute("DELETE FROM matches WHERE id=?", (line_id,))
+    c.execute("DELETE FROM games WHERE id=? AND NOT EXISTS (SELECT 1 FROM matches WHERE match_id=?)", (row[0], row[0]))
+    update_match_kpis(c, user, removed=[row[1:]])
+    conn.commit()
+
+def delete_match(conn, user, match_id):
+    c = conn.cursor()
+    old_rows = match_kpi_rows(c, "match_id=?", (match_id,))
+    c.execute("DELETE FROM matches WHERE match_id=?", (match_id,))
+    c.execute("DELETE FROM games WHERE id=? AND user_id=?", (match_id, user))
+    update_match_kpis(c, user, removed=old_rows)
+    conn.commit()
+
+def backfill_games(c):
+    """Cria os cabeçalhos em falta a partir das linhas de matches e liga-as por match_id."""
+    c.execute("""INSERT OR IGNORE INTO games (user_id, date, opponent, result, match_type)
+                 SELECT user_id, date, opponent, max(result), max(match_type) FROM matches
+                 WHERE match_id IS NULL GROUP BY user_id, date, opponent""")
+    c.execute("""UPDATE matches SET match_id = (SELECT g.id FROM games g WHERE g.user_id = matches.user_id
+                 AND g.date = matches.date AND g.opponent = matches.opponent) WHERE match_id IS NULL""")
+
+def match_changes_text(changes):
+    return f"{len(changes['inserted'])} novos, {len(changes['updated'])} alterados, {len(changes['deleted'])} removidos"
+
+def table_columns(c, table):
+    return {row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def add_column(c, table, col, decl):
+    """ALTER TABLE idempotente: só adiciona a coluna se ainda não existir."""
+    if col not in table_columns(c, table):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+# Índices secundários geridos pela app. Cada um serve consultas concretas do main_app();
+# os índices "idx_*" que deixem de estar nesta lista são apagados na migração.
+# Mexer nesta lista exige um passo novo em MIGRATIONS que volte a chamar sync_db_indexes().
+DB_INDEXES = [
+    # Todas as páginas: "SELECT ... FROM goalkeepers WHERE user_id=?"
+    ("idx_goalkeepers_user", "goalkeepers", "user_id"),
+    # Exercícios/Planear Dias: "WHERE user_id=?" (o PDF do treino filtra essa mesma leitura em memória)
+    ("idx_exercises_user", "exercises", "user_id"),
+    # Planear Dias/Relatórios: "WHERE user_id=? AND start_date=?"; Dashboard/Estatísticas: intervalos de start_date
+    ("idx_sessions_user_date", "sessions", "user_id, start_date"),
+    # Gestão Semanal/Relatórios: "WHERE user_id=? ORDER BY start_date DESC"
+    ("idx_microcycles_user_date", "microcycles", "user_id, start_date"),
+    # Relatórios (diário): "WHERE date=? AND gk_id=?"; Evolução: janelas (rating_windows) e notas recentes "WHERE gk_id=? AND date > ?"
+    ("idx_training_ratings_gk_date", "training_ratings", "gk_id, date"),
+    # Relatórios (semanal): "WHERE tr.user_id=? AND tr.date BETWEEN ..."
+    ("idx_training_ratings_user_date", "training_ratings", "user_id, date"),
+    # Presenças: "WHERE session_id=?" e JOIN attendance/sessions por session_id
+    ("idx_attendance_session", "attendance", "session_id, gk_id"),
+    # Estatísticas: contagem de presenças "a.gk_id=?" por atleta
+    ("idx_attendance_gk", "attendance", "gk_id, session_id"),
+    # Departamento Médico: "WHERE gk_id=? AND active=?"; Dashboard: lesões ativas por atleta
+    ("idx_injuries_gk_active", "injuries", "gk_id, active"),
+    # Scouting: "WHERE user_id=?"
+    ("idx_opponents_user", "opponents", "user_id"),
+    # Scouting: "WHERE opponent_id=?" (ficheiros e links de cada equipa)
+    ("idx_opponent_files_opp", "opponent_files", "opponent_id"),
+    # Biblioteca: "WHERE user_id=?"
+    ("idx_library_folders_user", "library_folders", "user_id"),
+    # Biblioteca: "WHERE folder_id=?"
+    ("idx_library_files_folder", "library_files", "folder_id"),
+    # Dashboard/forma: "WHERE user_id=? ORDER BY date DESC" (as fichas por jogo usam ux_matches_match_gk)
+    ("idx_matches_user_date", "matches", "user_id, date"),
+]
+
+def sync_db_indexes(c):
+    """Cria os índices de DB_INDEXES e apaga os "idx_*" antigos que já não constam da lista."""
+    wanted = {name for name, _, _ in DB_INDEXES}
+    for (name,) in c.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'").fetchall():
+        if name not in wanted:
+            c.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, table, cols in DB_INDEXES:
+        # Tabelas criadas por passos posteriores recebem os índices nesses passos
+        if table_columns(c, table):
+            c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
+    c.execute("PRAGMA optimize")
+
+# --- MIGRAÇÕES DE ESQUEMA (PRAGMA user_version) ---
+# Cada passo é idempotente e corre uma única vez por DB, pela ordem da lista.
+# Alterações futuras ao esquema entram SEMPRE como um novo passo no fim de MIGRATIONS.
+
+def _mig_base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS goalkeepers (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT, age INTEGER, status TEXT, notes TEXT, height REAL, wingspan REAL, arm_len_left REAL, arm_len_right REAL, glove_size TEXT, jump_front_2 REAL, jump_front_l REAL, jump_front_r REAL, jump_lat_l REAL, jump_lat_r REAL, test_res TEXT, test_agil TEXT, test_vel TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS exercises (id INTEGER PRIMARY KEY, user_id TEXT, title TEXT, moment TEXT, training_type TEXT, description TEXT, objective TEXT, materials TEXT, space TEXT, image BLOB)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, user_id TEXT, type TEXT, title TEXT, start_date TEXT, drills_list TEXT, report TEXT, status TEXT, opponent TEXT, match_time TEXT, location TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS microcycles (id INTEGER PRIMARY KEY, user_id TEXT, title TEXT, start_date TEXT, goal TEXT, report TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS training_ratings (id INTEGER PRIMARY KEY, user_id TEXT, date TEXT, gk_id INTEGER, rating INTEGER, notes TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS attendance (id INTEGER PRIMARY KEY, session_id INTEGER, gk_id INTEGER, status TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS injuries (id INTEGER PRIMARY KEY, gk_id INTEGER, injury_date TEXT, recovery_weeks INTEGER, description TEXT, active INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS opponents (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT, notes TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS opponent_files (id INTEGER PRIMARY KEY, opponent_id INTEGER, name TEXT, type TEXT, content BLOB, link TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS library_folders (id INTEGER PRIMARY KEY, user_id TEXT, name TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS library_files (id INTEGER PRIMARY KEY, folder_id INTEGER, name TEXT, type TEXT, content BLOB, link TEXT, description TEXT)''')
+    # Tabela matches completa (V62)
+    c.execute('''CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY, user_id TEXT, date TEXT, opponent TEXT, gk_id INTEGER, goals_conceded INTEGER, saves INTEGER, result TEXT, report TEXT, rating INTEGER, match_type TEXT,
+                    
+                    -- Colunas Tempo e Subs
+                    match_duration INTEGER DEFAULT 90, 
+                    sub_gk_id INTEGER, 
+                    sub_minute INTEGER, 
+                    sub2_gk_id INTEGER, 
+                    sub2_minute INTEGER,
+                    
+                    -- Colunas Remates e Psicologia
+                    shots_faced INTEGER, 
+                    shots_off_target INTEGER, 
+                    psy_comm INTEGER, 
+                    psy_decision INTEGER, 
+                    psy_posture INTEGER, 
+                    psy_resilience INTEGER,
+                    
+                    -- Estatísticas Técnicas (72 Variáveis)
+                    db_bloq_sq_rast INTEGER, db_bloq_sq_med INTEGER, db_bloq_sq_alt INTEGER, db_bloq_cq_rast INTEGER, db_bloq_cq_med INTEGER, db_bloq_cq_alt INTEGER, 
+                    db_rec_sq_med INTEGER, db_rec_sq_alt INTEGER, db_rec_cq_rast INTEGER, db_rec_cq_med INTEGER, db_rec_cq_alt INTEGER, db_rec_cq_varr INTEGER, 
+                    db_desv_sq_pe INTEGER, db_desv_sq_mfr INTEGER, db_desv_sq_mlat INTEGER, db_desv_sq_a1 INTEGER, db_desv_sq_a2 INTEGER, db_desv_cq_varr INTEGER, db_desv_cq_r1 INTEGER, db_desv_cq_r2 INTEGER, db_desv_cq_a1 INTEGER, db_desv_cq_a2 INTEGER, 
+                    db_ext_rec INTEGER, db_ext_desv_1 INTEGER, db_ext_desv_2 INTEGER, db_voo_rec INTEGER, db_voo_desv_1 INTEGER, db_voo_desv_2 INTEGER, db_voo_desv_mc INTEGER, 
+                    de_cabeca INTEGER, de_carrinho INTEGER, de_alivio INTEGER, de_rececao INTEGER, 
+                    duelo_parede INTEGER, duelo_abafo INTEGER, duelo_estrela INTEGER, duelo_frontal INTEGER, 
+                    pa_curto_1 INTEGER, pa_curto_2 INTEGER, pa_longo_1 INTEGER, pa_longo_2 INTEGER, dist_curta_mao INTEGER, dist_longa_mao INTEGER, dist_picada_mao INTEGER, dist_volley INTEGER, dist_curta_pe INTEGER, dist_longa_pe INTEGER, 
+                    cruz_rec_alta INTEGER, cruz_soco_1 INTEGER, cruz_soco_2 INTEGER, cruz_int_rast INTEGER,
+                    eto_pb_curto INTEGER, eto_pb_medio INTEGER, eto_pb_longo INTEGER)''')
+
+def _mig_v62_columns(c):
+    # Colunas que as DBs anteriores à V62 não têm
+    for t, c_n, tp in [
+        ("sessions", "match_time", "TEXT"),
+        ("matches", "match_duration", "INTEGER DEFAULT 90"),
+        ("matches", "sub_gk_id", "INTEGER"),
+        ("matches", "sub_minute", "INTEGER"),
+        ("matches", "sub2_gk_id", "INTEGER"),
+        ("matches", "sub2_minute", "INTEGER"),
+        ("matches", "shots_faced", "INTEGER"),
+        ("matches", "shots_off_target", "INTEGER"),
+        ("matches", "psy_comm", "INTEGER"),
+        ("matches", "psy_decision", "INTEGER"),
+        ("matches", "psy_posture", "INTEGER"),
+        ("matches", "psy_resilience", "INTEGER"),
+    ]:
+        add_column(c, t, c_n, tp)
+
+def _mig_blob_store(c):
+    for table, _, hash_col, size_col in BLOB_COLUMNS:
+        add_column(c, table, hash_col, "TEXT")
+        add_column(c, table, size_col, "INTEGER")
+    # Só vale a pena compactar o ficheiro se havia bytes nas tabelas
+    return move_blobs_to_store(c) > 0
+
+def _mig_match_kpis(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS match_kpis (user_id TEXT PRIMARY KEY, games INTEGER DEFAULT 0,
+                 clean_sheets INTEGER DEFAULT 0, goals_conceded INTEGER DEFAULT 0, saves INTEGER DEFAULT 0,
+                 form TEXT, updated TEXT)""")
+    rebuild_match_kpis(c)
+
+# Passos que devolvem True pedem um VACUUM depois do commit
+def _mig_match_unique_key(c):
+    # Duplicados antigos (mesmo GR gravado duas vezes no mesmo jogo): fica a linha mais recente
+    # e as outras passam, com todas as colunas, para matches_dupes em vez de se perderem
+    dupes = "id NOT IN (SELECT max(id) FROM matches GROUP BY user_id, date, opponent, gk_id)"
+    if c.execute(f"SELECT 1 FROM matches WHERE {dupes} LIMIT 1").fetchone():
+        c.execute("CREATE TABLE IF NOT EXISTS matches_dupes AS SELECT * FROM matches WHERE 0")
+        c.execute(f"INSERT INTO matches_dupes SELECT * FROM matches WHERE {dupes}")
+        c.execute(f"DELETE FROM matches WHERE {dupes}")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_matches_game_gk ON matches (user_id, date, opponent, gk_id)")
+    rebuild_match_kpis(c)
+    sync_db_indexes(c)
+
+def _mig_games(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS games (id INTEGER PRIMARY KEY, user_id TEXT, date TEXT, opponent TEXT,
+                 result TEXT, match_type TEXT, UNIQUE (user_id, date, opponent))""")
+    add_column(c, "matches", "match_id", "INTEGER")
+    backfill_games(c)
+    # A ficha passa a ser única por (jogo, guarda-redes); a chave por texto deixa de ser precisa
+    c.execute("DROP INDEX IF EXISTS ux_matches_game_gk")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_matches_match_gk ON matches (match_id, gk_id)")
+    sync_db_indexes(c)
+
+def _mig_match_actions(c):
+    c.execute("CREATE TABLE IF NOT EXISTS action_catalog (code TEXT PRIMARY KEY, family TEXT, position INTEGER)")
+    c.execute("""CREATE TABLE IF NOT EXISTS match_actions (line_id INTEGER, code TEXT, count INTEGER,
+                 PRIMARY KEY (line_id, code)) WITHOUT ROWID""")
+    # Apagar uma ficha (ou um jogo) leva as suas ações, seja qual for o caminho do DELETE
+    c.execute("""CREATE TRIGGER IF NOT EXISTS trg_matches_actions_delete AFTER DELETE ON matches
+                 BEGIN DELETE FROM match_actions WHERE line_id = OLD.id; END""")
+    seed_action_catalog(c)
+    existing = set(table_columns(c, "matches"))
+    for code in MATCH_TECH_COLUMNS:
+        if code in existing:
+            c.execute(f"INSERT OR IGNORE INTO match_actions SELECT id, ?, CAST({code} AS INTEGER) FROM matches WHERE {code} > 0", (code,))
+            c.execute(f"ALTER TABLE matches DROP COLUMN {code}")
+    return True
+
+def _mig_rating_trends(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS rating_trends (user_id TEXT, gk_id INTEGER, period TEXT, period_key TEXT,
+                 n INTEGER DEFAULT 0, total REAL DEFAULT 0, total_sq REAL DEFAULT 0,
+                 PRIMARY KEY (user_id, gk_id, period, period_key))""")
+    rebuild_rating_trends(c)
+
+MIGRATIONS = [
+    (1, "tabelas base", _mig_base_tables),
+    (2, "colunas V62", _mig_v62_columns),
+    (3, "índices geridos", sync_db_indexes),
+    (4, "blobs no armazém por hash", _mig_blob_store),
+    (5, "resumo de KPIs dos jogos", _mig_match_kpis),
+    (6, "chave única jogo/guarda-redes", _mig_match_unique_key),
+    (7, "cabeçalho de jogo (games) e match_id", _mig_games),
+    (8, "ações técnicas em formato longo", _mig_match_actions),
+    (9, "tendências das avaliações de treino", _mig_rating_trends),
+    (10, "índice de exercícios só por treinador", sync_db_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate_db(conn):
+    """Aplica os passos em falta. Numa DB já atual custa só a leitura do user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return version
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    vacuum = False
+    try:
+        # Outra sessão pode ter migrado entretanto: reler já com o lock de escrita
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for v, _, step in MIGRATIONS:
+            if v > version:
+                vacuum = bool(step(c)) or vacuum
+                c.execute(f"PRAGMA user_version = {v}")
+                version = v
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if vacuum:
+        conn.execute("VACUUM")
+    return version
+
+def check_db_updates(db_file=None):
+    """Garante que a DB está na versão de esquema mais recente (ver MIGRATIONS)."""
+    conn = get_db_connection(db_file)
+    try:
+        migrate_db(conn)
     except Exception as e:
         st.error(f"Erro Base de Dados: {e}")
     finally:
@@ -166,11 +2010,15 @@ def check_db_updates():
 # 3. HELPER FUNCTIONS E STARTUP
 # ==========================================
 
-# Sincronização inicial
+# Sincronização inicial (em modo sharded só a DB de autenticação; a do treinador vem no login)
 if 'drive_synced' not in st.session_state:
     with st.spinner("A carregar..."):
-        sync_download_db()
-        check_db_updates()
+        sync_download_db(auth_db_file())
+        if STORAGE_MODE == "sharded":
+            init_auth_db()
+        else:
+            check_db_updates()
+    start_blob_maintenance()
     st.session_state['drive_synced'] = True
 
 def make_hashes(p):
@@ -268,10 +2116,10 @@ def create_training_pdf(user, session_info, athletes, drills_config, drills_deta
                 pdf.ln(2)
                 
                 # Imagem do Exercício
-                if row['image']:
+                if row['image_hash']:
                     try:
                         with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as ti:
-                            img = Image.open(io.BytesIO(row['image']))
+                            img = Image.open(io.BytesIO(get_blob(row['image_hash'])))
                             img.save(ti.name)
                             pdf.image(ti.name, x=10, w=100)
                             pdf.ln(5)
@@ -288,6 +2136,54 @@ def create_training_pdf(user, session_info, athletes, drills_config, drills_deta
     
     return pdf.output(dest='S').encode('latin-1')
 
+def load_week_plan(user, start_str, end_str):
+    """Gestão Semanal: sessões e presenças da semana inteira, com uma consulta por tabela.
+    Devolve ({data: DataFrame da sessão do dia}, {session_id: [gk_id, ...]}, DataFrame vazio p/ dias livres)."""
+    conn = get_db_connection()
+    try:
+        sessions = pd.read_sql_query("SELECT * FROM sessions WHERE user_id=? AND start_date BETWEEN ? AND ? ORDER BY start_date, id",
+                                     conn, params=(user, start_str, end_str))
+        att = pd.read_sql_query("""SELECT a.session_id, a.gk_id FROM attendance a JOIN sessions s ON a.session_id = s.id
+                                   WHERE s.user_id=? AND s.start_date BETWEEN ? AND ?""", conn, params=(user, start_str, end_str))
+    finally:
+        conn.close()
+    by_day = {d: g.head(1) for d, g in sessions.groupby('start_date', sort=False)}
+    present = att.groupby('session_id')['gk_id'].apply(list).to_dict()
+    return by_day, present, sessions.iloc[0:0]
+
+# Treinos que contam para a assiduidade (os cancelados ficam de fora)
+VALID_TRAININGS = "SELECT id, start_date FROM sessions WHERE user_id=? AND type='Treino' AND (status IS NULL OR status != 'Cancelado') AND start_date >= ? AND start_date <= ?"
+
+def attendance_summary(user, start_str, end_str):
+    """Presenças por atleta no intervalo, numa única consulta agrupada."""
+    return cached_query("assiduidade", ("goalkeepers", "sessions", "attendance"), f"""
+        WITH valid AS ({VALID_TRAININGS})
+        SELECT g.id, g.name, count(a.session_id) AS presences, (SELECT count(*) FROM valid) AS total
+        FROM goalkeepers g LEFT JOIN attendance a ON a.gk_id = g.id AND a.session_id IN (SELECT id FROM valid)
+        WHERE g.user_id=? GROUP BY g.id, g.name ORDER BY g.id""", (user, start_str, end_str, user))
+
+def attendance_matrix(user, start_str, end_str):
+    """Matriz atleta × treino (1 = presente), com as datas dos treinos como colunas."""
+    rec = cached_query("matriz presenças", ("sessions", "attendance"), f"""
+        WITH valid AS ({VALID_TRAININGS})
+        SELECT v.id AS session_id, v.start_date, a.gk_id FROM valid v LEFT JOIN attendance a ON a.session_id = v.id
+        ORDER BY v.start_date, v.id""", (user, start_str, end_str))
+    gks = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
+    sess = rec[['session_id', 'start_date']].drop_duplicates('session_id')
+    pres = rec.dropna(subset=['gk_id'])
+    m = pd.crosstab(pres['gk_id'].astype(int), pres['session_id']).clip(upper=1)
+    m = m.reindex(index=gks['id'], columns=sess['session_id'], fill_value=0)
+    m.index = gks['name']
+    m.columns = pd.to_datetime(sess['start_date'].str[:10])
+    return m
+
+def attendance_breakdown(matrix, freq):
+    """% de assiduidade por período ("W" semana, "M" mês) a partir da matriz."""
+    periods = matrix.columns.to_period(freq)
+    present = matrix.T.groupby(periods).sum().T
+    totals = pd.Series(1, index=periods).groupby(level=0).sum()
+    return (100 * present / totals).round(1)
+
 # ==========================================
 # 4. LOGIN & MAIN (SETUP)
 # ==========================================
@@ -303,10 +2199,12 @@ def login_page():
         user = st.text_input("Utilizador")
         pwd = st.text_input("Password", type='password')
         if st.button("Entrar"):
-            conn = get_db_connection()
+            conn = get_auth_connection()
             c = conn.cursor()
             c.execute("SELECT * FROM users WHERE username=? AND password=?", (user, make_hashes(pwd)))
-            if c.fetchall():
+            found = c.fetchall()
+            conn.close()
+            if found:
                 st.session_state['logged_in'] = True
                 st.session_state['username'] = user
                 st.rerun()
@@ -317,12 +2215,12 @@ def login_page():
         new_u = st.text_input("Novo User")
         new_p = st.text_input("Nova Pass", type='password')
         if st.button("Registar"):
-            conn = get_db_connection()
+            conn = get_auth_connection()
             try:
                 conn.cursor().execute("INSERT INTO users VALUES (?,?)", (new_u, make_hashes(new_p)))
                 conn.commit()
                 st.success("Conta criada!")
-                backup_to_drive()
+                schedule_backup(auth_db_file())
             except:
                 st.warning("Já existe.")
             conn.close()
@@ -333,6 +2231,12 @@ def login_page():
 # ==========================================
 def main_app():
     user = st.session_state['username']
+    if STORAGE_MODE == "sharded" and st.session_state.get('user_db_ready') != user:
+        with st.spinner("A carregar os teus dados..."):
+            ready = prepare_user_db(user)
+        if not ready:
+            st.stop()
+        st.session_state['user_db_ready'] = user
     st.sidebar.title(f"👤 {user}")
     
     menu = st.sidebar.radio("Navegação", 
@@ -349,8 +2253,12 @@ def main_app():
          "Exercícios",
          "💾 Backups & Dados"])
     
+    last_ok = get_upload_worker().last_success
+    st.sidebar.caption(f"☁️ Último backup: {last_ok.strftime('%H:%M:%S')}" if last_ok else "☁️ Sem backups nesta sessão")
+
     if st.sidebar.button("Sair"):
-        backup_to_drive()
+        if local_db_ahead(current_db_file()):
+            flush_backup("logout")
         st.session_state['logged_in'] = False
         st.rerun()
 
@@ -365,13 +2273,8 @@ def main_app():
         st.subheader("🔥 Performance da Época")
         col1, col2, col3, col4 = st.columns(4)
         
-        total_games = conn.execute("SELECT count(*) FROM matches WHERE user_id=?", (user,)).fetchone()[0]
-        clean_sheets = conn.execute("SELECT count(*) FROM matches WHERE user_id=? AND goals_conceded = 0", (user,)).fetchone()[0]
-        goals_conc = conn.execute("SELECT sum(goals_conceded) FROM matches WHERE user_id=?", (user,)).fetchone()[0]
-        total_saves = conn.execute("SELECT sum(saves) FROM matches WHERE user_id=?", (user,)).fetchone()[0]
-        
-        goals_conc = goals_conc if goals_conc else 0
-        total_saves = total_saves if total_saves else 0
+        # Uma linha de match_kpis em vez de varrer matches (mantida pelo Centro de Jogo)
+        total_games, clean_sheets, goals_conc, total_saves, form = read_match_kpis(user)
         avg_goals = goals_conc / total_games if total_games > 0 else 0
         
         col1.metric("🛡️ Clean Sheets", clean_sheets)
@@ -407,7 +2310,7 @@ def main_app():
             
             st.markdown("---")
             st.subheader("📉 Forma (Últimos 5 Jogos)")
-            last_5 = pd.read_sql_query("SELECT opponent, goals_conceded FROM matches WHERE user_id=? ORDER BY date DESC LIMIT 5", conn, params=(user,))
+            last_5 = pd.DataFrame(form, columns=["date", "opponent", "goals_conceded"])
             if not last_5.empty:
                 last_5 = last_5.iloc[::-1] # Inverter para mostrar cronologicamente
                 st.line_chart(last_5.set_index("opponent")['goals_conceded'])
@@ -465,17 +2368,17 @@ def main_app():
                     conn = get_db_connection()
                     c = conn.cursor()
                     c.execute("INSERT INTO microcycles (user_id, title, start_date, goal) VALUES (?,?,?,?)", (user, mt, sd, mg))
+                    rebuild_rating_trends(c, user)
                     conn.commit(); conn.close()
-                    backup_to_drive()
+                    bump_tables("microcycles", "rating_trends")
+                    schedule_backup()
                     st.success("Semana Criada com Sucesso!")
                     st.rerun()
             
             st.divider()
             st.subheader("⚙️ Gerir Semanas Existentes")
             
-            conn = get_db_connection()
-            micros_exist = pd.read_sql_query("SELECT * FROM microcycles WHERE user_id=? ORDER BY start_date DESC", conn, params=(user,))
-            conn.close()
+            micros_exist = cached_query("microcycles", ("microcycles",), "SELECT * FROM microcycles WHERE user_id=? ORDER BY start_date DESC", (user,))
             
             if not micros_exist.empty:
                 week_opts = [f"{row['title']} (Início: {row['start_date']})" for _, row in micros_exist.iterrows()]
@@ -499,8 +2402,10 @@ def main_app():
                     if st.form_submit_button("💾 Atualizar Semana"):
                         conn = get_db_connection()
                         conn.cursor().execute("UPDATE microcycles SET title=?, start_date=?, goal=? WHERE id=?", (new_title, new_date, new_goal, mid))
+                        rebuild_rating_trends(conn.cursor(), user)
                         conn.commit(); conn.close()
-                        backup_to_drive()
+                        bump_tables("microcycles", "rating_trends")
+                        schedule_backup()
                         st.success("Semana atualizada!")
                         st.rerun()
                 
@@ -509,17 +2414,17 @@ def main_app():
                     if st.button("Sim, apagar permanentemente", key=f"del_micro_{mid}"):
                         conn = get_db_connection()
                         conn.cursor().execute("DELETE FROM microcycles WHERE id=?", (mid,))
+                        rebuild_rating_trends(conn.cursor(), user)
                         conn.commit(); conn.close()
-                        backup_to_drive()
+                        bump_tables("microcycles", "rating_trends")
+                        schedule_backup()
                         st.success("Semana apagada.")
                         st.rerun()
             else:
                 st.info("Ainda não tens semanas criadas.")
         
         with tab2:
-            conn = get_db_connection()
-            micros = pd.read_sql_query("SELECT * FROM microcycles WHERE user_id = ? ORDER BY start_date DESC", conn, params=(user,))
-            conn.close()
+            micros = cached_query("microcycles", ("microcycles",), "SELECT * FROM microcycles WHERE user_id=? ORDER BY start_date DESC", (user,))
             
             if not micros.empty:
                 sel_micro = st.selectbox("Escolher Semana para Planear", micros['title'].unique())
@@ -527,14 +2432,17 @@ def main_app():
                 base_date = datetime.strptime(micro_data['start_date'], '%Y-%m-%d')
                 st.info(f"🎯 Objetivo: {micro_data['goal']}")
                 
+                # Semana inteira de uma vez; atletas e exercícios vêm da cache de consultas
+                week_sess, week_att, no_sess = load_week_plan(user, base_date.strftime("%Y-%m-%d"), (base_date + timedelta(days=6)).strftime("%Y-%m-%d"))
+                all_gks = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
+                ddb = cached_query("exercises", ("exercises",), "SELECT id, title, moment, training_type, description, objective, materials, space, image_hash FROM exercises WHERE user_id=?", (user,))
+                
                 for i in range(7):
                     curr = base_date + timedelta(days=i)
                     d_str = curr.strftime("%Y-%m-%d")
                     d_name = curr.strftime("%A")
                     
-                    conn_d = get_db_connection()
-                    sess = pd.read_sql_query("SELECT * FROM sessions WHERE user_id=? AND start_date=?", conn_d, params=(user, d_str))
-                    conn_d.close()
+                    sess = week_sess.get(d_str, no_sess)
                     
                     icon = "⚪"
                     header_extra = ""
@@ -568,28 +2476,22 @@ def main_app():
                                 drill_names = [d['title'] for d in drills_config]
                                 
                                 if drill_names:
-                                    ph = ','.join('?' for _ in drill_names)
-                                    q = f"SELECT * FROM exercises WHERE user_id=? AND title IN ({ph})"
-                                    p = [user] + drill_names
-                                    conn_pdf = get_db_connection()
-                                    d_df = pd.read_sql_query(q, conn_pdf, params=p)
-                                    a_df = pd.read_sql_query("SELECT name, status FROM goalkeepers WHERE user_id=?", conn_pdf, params=(user,))
-                                    conn_pdf.close()
-                                    try:
-                                        pdf_bytes = create_training_pdf(user, s_data, a_df, drills_config, d_df)
-                                        st.download_button("📥 Baixar PDF do Treino", pdf_bytes, f"Treino_{d_str}.pdf", "application/pdf")
-                                    except Exception as e:
-                                        st.error(f"Erro PDF: {e}")
+                                    # O PDF (com imagens) só é gerado quando pedido, não em cada render da semana
+                                    ready = st.session_state.get('week_pdf')
+                                    if ready and ready[0] == d_str:
+                                        st.download_button("📥 Baixar PDF do Treino", ready[1], f"Treino_{d_str}.pdf", "application/pdf")
+                                    elif st.button("📄 Gerar PDF do Treino", key=f"pdf_{d_str}"):
+                                        d_df = ddb[ddb['title'].isin(drill_names)]
+                                        try:
+                                            st.session_state['week_pdf'] = (d_str, create_training_pdf(user, s_data, all_gks, drills_config, d_df))
+                                            st.rerun()
+                                        except Exception as e:
+                                            st.error(f"Erro PDF: {e}")
                             
                             st.markdown("---")
                             st.markdown("#### 🙋‍♂️ Registo de Presenças")
-                            conn_p = get_db_connection()
-                            all_gks = pd.read_sql_query("SELECT id, name FROM goalkeepers WHERE user_id=?", conn_p, params=(user,))
                             sess_id = int(sess.iloc[0]['id'])
-                            pres_exist = pd.read_sql_query("SELECT gk_id FROM attendance WHERE session_id=?", conn_p, params=(sess_id,))
-                            conn_p.close()
-                            
-                            current_present_ids = pres_exist['gk_id'].tolist() if not pres_exist.empty else []
+                            current_present_ids = week_att.get(sess_id, [])
                             current_present_names = all_gks[all_gks['id'].isin(current_present_ids)]['name'].tolist()
                             
                             with st.form(f"att_{d_str}"):
@@ -602,7 +2504,8 @@ def main_app():
                                     for gk_id in ids_to_save:
                                         c.execute("INSERT INTO attendance (session_id, gk_id, status) VALUES (?,?,?)", (sess_id, gk_id, 'Presente'))
                                     conn_s.commit(); conn_s.close()
-                                    backup_to_drive()
+                                    bump_tables("attendance")
+                                    schedule_backup()
                                     st.success("Presenças Atualizadas!")
                             st.markdown("---")
 
@@ -649,9 +2552,6 @@ def main_app():
                             if type_d == "Treino":
                                 current_config = parse_drills(sess.iloc[0]['drills_list']) if not sess.empty else []
                                 current_titles = [d['title'] for d in current_config]
-                                conn_ex = get_db_connection()
-                                ddb = pd.read_sql_query("SELECT title, moment, training_type FROM exercises WHERE user_id=?", conn_ex, params=(user,))
-                                conn_ex.close()
                                 all_types = sorted(ddb['training_type'].unique().tolist()) if not ddb.empty else ["Técnico", "Tático"]
                                 type_filter = st.multiselect("Filtrar Tipo de Exercício", all_types, default=all_types, key=f"ft_{d_str}")
                                 moms = ["Defesa de Baliza", "Defesa do Espaço", "Cruzamento", "Duelos", "Distribuição", "Passe Atrasado"]
@@ -693,7 +2593,9 @@ def main_app():
                                                  VALUES (?,?,?,?,?,?,?,?,?)""", 
                                               (user, type_d, sess_t, d_str, drills_json, status_d, save_opp, s_time_str, save_loc))
                                 conn_s.commit(); conn_s.close()
-                                backup_to_drive()
+                                st.session_state.pop('week_pdf', None)
+                                bump_tables("sessions")
+                                schedule_backup()
                                 st.success("Guardado com sucesso!"); st.rerun()
             else: st.warning("Cria uma semana primeiro.")
 
@@ -705,30 +2607,36 @@ def main_app():
         end_filter = col_d2.date_input("Até:", value=date.today())
         
         if start_filter <= end_filter:
-            conn = get_db_connection()
-            total_sessions = conn.execute("SELECT count(*) FROM sessions WHERE user_id=? AND type='Treino' AND (status IS NULL OR status != 'Cancelado') AND start_date >= ? AND start_date <= ?", (user, start_filter, end_filter)).fetchone()[0]
-            gks = pd.read_sql_query("SELECT id, name FROM goalkeepers WHERE user_id=?", conn, params=(user,))
-            att_data = []
+            s_str, e_str = str(start_filter), str(end_filter)
+            summary = attendance_summary(user, s_str, e_str)
+            total_sessions = int(summary['total'].iloc[0]) if not summary.empty else 0
             if total_sessions > 0:
-                for _, gk in gks.iterrows():
-                    n_p = conn.execute("""SELECT count(*) FROM attendance a JOIN sessions s ON a.session_id = s.id WHERE s.user_id=? AND a.gk_id=? AND s.type='Treino' AND (s.status IS NULL OR s.status != 'Cancelado') AND s.start_date >= ? AND s.start_date <= ?""", (user, gk['id'], start_filter, end_filter)).fetchone()[0]
-                    att_data.append({"Nome": gk['name'], "Presenças": n_p, "Total Treinos": total_sessions, "% Assiduidade": f"{(n_p/total_sessions)*100:.1f}%"})
-                df_att = pd.DataFrame(att_data)
+                df_att = pd.DataFrame({"Nome": summary['name'], "Presenças": summary['presences'], "Total Treinos": total_sessions,
+                                       "% Assiduidade": (100 * summary['presences'] / total_sessions).map(lambda v: f"{v:.1f}%")})
                 st.subheader(f"Resumo ({start_filter} a {end_filter})")
                 st.metric("Total de Treinos Realizados", total_sessions)
                 st.dataframe(df_att, use_container_width=True)
                 if not df_att.empty:
-                    df_att['Val'] = df_att['% Assiduidade'].str.replace('%','').astype(float)
+                    df_att['Val'] = (100 * summary['presences'] / total_sessions).round(1)
                     st.bar_chart(df_att.set_index("Nome")['Val'])
+
+                st.subheader("🗓️ Matriz de Presenças")
+                view = st.radio("Vista", ["Por Treino", "Por Semana", "Por Mês"], horizontal=True)
+                matrix = attendance_matrix(user, s_str, e_str)
+                if view == "Por Treino":
+                    shown = matrix.replace({1: "✅", 0: ""})
+                    shown.columns = [d.strftime("%d/%m") for d in matrix.columns]
+                else:
+                    shown = attendance_breakdown(matrix, "W" if view == "Por Semana" else "M")
+                    shown.columns = [f"Sem. {p.start_time:%d/%m}" if view == "Por Semana" else f"{p.start_time:%m/%Y}" for p in shown.columns]
+                    st.caption("% de assiduidade em cada período.")
+                st.dataframe(shown, use_container_width=True)
             else: st.info("Não existem treinos registados neste intervalo.")
-            conn.close()
 
     # --- 3. ESCOUTING E ADVERSÁRIOS ---
     elif menu == "Scouting & Adversários":
         st.header("🕵️ Scouting de Adversários")
-        conn = get_db_connection()
-        opps = pd.read_sql_query("SELECT * FROM opponents WHERE user_id=?", conn, params=(user,))
-        conn.close()
+        opps = cached_query("opponents", ("opponents",), "SELECT * FROM opponents WHERE user_id=?", (user,))
         
         col_list, col_detail = st.columns([1, 2])
         
@@ -740,7 +2648,8 @@ def main_app():
                     conn = get_db_connection()
                     conn.cursor().execute("INSERT INTO opponents (user_id, name) VALUES (?,?)", (user, new_opp_name))
                     conn.commit(); conn.close()
-                    backup_to_drive()
+                    bump_tables("opponents")
+                    schedule_backup()
                     st.success("Criado com sucesso!")
                     st.rerun()
             
@@ -765,7 +2674,8 @@ def main_app():
                             conn = get_db_connection()
                             conn.cursor().execute("UPDATE opponents SET name=? WHERE id=?", (new_team_name, opp_id))
                             conn.commit(); conn.close()
-                            backup_to_drive()
+                            bump_tables("opponents")
+                            schedule_backup()
                             st.success("Renomeado!")
                             st.rerun()
                         
@@ -776,7 +2686,8 @@ def main_app():
                             conn.cursor().execute("DELETE FROM opponent_files WHERE opponent_id=?", (opp_id,))
                             conn.cursor().execute("DELETE FROM opponents WHERE id=?", (opp_id,))
                             conn.commit(); conn.close()
-                            backup_to_drive()
+                            bump_tables("opponents")
+                            schedule_backup(); schedule_blob_sweep()
                             st.success("Equipa Apagada!")
                             st.rerun()
 
@@ -786,7 +2697,8 @@ def main_app():
                         conn = get_db_connection()
                         conn.cursor().execute("UPDATE opponents SET notes=? WHERE id=?", (notes, opp_id))
                         conn.commit(); conn.close()
-                        backup_to_drive()
+                        bump_tables("opponents")
+                        schedule_backup()
                         st.success("Guardado")
                 
                 st.markdown("---")
@@ -800,11 +2712,11 @@ def main_app():
                         upl_file = st.file_uploader("PDF, Imagem, PPT", key="opp_upl")
                         if st.button("Guardar Ficheiro"):
                             if upl_file:
-                                blob = upl_file.read()
+                                blob_hash, blob_size = put_blob(upl_file.read())
                                 conn = get_db_connection()
-                                conn.cursor().execute("INSERT INTO opponent_files (opponent_id, name, type, content) VALUES (?,?,?,?)", (opp_id, upl_file.name, "file", blob))
+                                conn.cursor().execute("INSERT INTO opponent_files (opponent_id, name, type, content_hash, content_size) VALUES (?,?,?,?,?)", (opp_id, upl_file.name, "file", blob_hash, blob_size))
                                 conn.commit(); conn.close()
-                                backup_to_drive()
+                                schedule_backup()
                                 st.success("Ficheiro anexado!")
                                 st.rerun()
                     with c_lnk:
@@ -816,12 +2728,12 @@ def main_app():
                                 conn = get_db_connection()
                                 conn.cursor().execute("INSERT INTO opponent_files (opponent_id, name, type, link) VALUES (?,?,?,?)", (opp_id, lnk_name, "link", lnk_url))
                                 conn.commit(); conn.close()
-                                backup_to_drive()
+                                schedule_backup()
                                 st.success("Link guardado!")
                                 st.rerun()
 
                 conn = get_db_connection()
-                files = pd.read_sql_query("SELECT * FROM opponent_files WHERE opponent_id=?", conn, params=(opp_id,))
+                files = pd.read_sql_query("SELECT id, name, type, link, content_hash, content_size FROM opponent_files WHERE opponent_id=?", conn, params=(opp_id,))
                 conn.close()
                 
                 docs = files[files['type'] == 'file']
@@ -833,19 +2745,20 @@ def main_app():
                             with st.expander(f"📄 {f['name']}"):
                                 c1, c2 = st.columns([3, 1])
                                 with c1:
-                                    st.download_button("📥 Download", f['content'], file_name=f['name'], key=f"dl_{f['id']}")
+                                    st.caption(fmt_size(f['content_size']))
+                                    blob_download_button("📥 Download", f['content_hash'], f['name'], f"dl_{f['id']}")
                                 with c2:
                                     with st.popover("⚙️ Gerir"):
                                         new_name = st.text_input("Novo nome", f['name'], key=f"ren_{f['id']}")
                                         if st.button("Renomear", key=f"btn_ren_{f['id']}"):
                                             conn = get_db_connection()
                                             conn.cursor().execute("UPDATE opponent_files SET name=? WHERE id=?", (new_name, f['id']))
-                                            conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                                            conn.commit(); conn.close(); schedule_backup(); st.rerun()
                                         st.divider()
                                         if st.button("🗑️ Apagar Documento", key=f"del_doc_{f['id']}"):
                                             conn = get_db_connection()
                                             conn.cursor().execute("DELETE FROM opponent_files WHERE id=?", (f['id'],))
-                                            conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                                            conn.commit(); conn.close(); schedule_backup(); schedule_blob_sweep(); st.rerun()
                     else:
                         st.info("Sem documentos anexados.")
 
@@ -869,12 +2782,12 @@ def main_app():
                                     if st.button("Renomear", key=f"btn_ren_lnk_{f['id']}"):
                                         conn = get_db_connection()
                                         conn.cursor().execute("UPDATE opponent_files SET name=? WHERE id=?", (new_name, f['id']))
-                                        conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                                        conn.commit(); conn.close(); schedule_backup(); st.rerun()
                                     st.divider()
                                     if st.button("🗑️ Apagar Link", key=f"del_lnk_{f['id']}"):
                                         conn = get_db_connection()
                                         conn.cursor().execute("DELETE FROM opponent_files WHERE id=?", (f['id'],))
-                                        conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                                        conn.commit(); conn.close(); schedule_backup(); st.rerun()
                     else:
                         st.info("Sem links ou vídeos.")
 
@@ -896,7 +2809,7 @@ def main_app():
                 if st.form_submit_button("Criar"):
                     conn = get_db_connection()
                     conn.cursor().execute("INSERT INTO library_folders (user_id, name) VALUES (?,?)", (user, nf))
-                    conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                    conn.commit(); conn.close(); schedule_backup(); st.rerun()
             if not folders.empty: sel_folder = st.radio("Navegar:", folders['name'].tolist())
             else: sel_folder = None
             
@@ -911,20 +2824,20 @@ def main_app():
                         desc_f = st.text_input("Descrição (Opcional)", key="df")
                         if st.button("Carregar Documento"):
                             if lf:
-                                blob = lf.read()
+                                blob_hash, blob_size = put_blob(lf.read())
                                 conn = get_db_connection()
-                                conn.cursor().execute("INSERT INTO library_files (folder_id, name, type, content, description) VALUES (?,?,?,?,?)", (folder_id, lf.name, "file", blob, desc_f))
-                                conn.commit(); conn.close(); backup_to_drive(); st.success("Adicionado!"); st.rerun()
+                                conn.cursor().execute("INSERT INTO library_files (folder_id, name, type, content_hash, content_size, description) VALUES (?,?,?,?,?,?)", (folder_id, lf.name, "file", blob_hash, blob_size, desc_f))
+                                conn.commit(); conn.close(); schedule_backup(); st.success("Adicionado!"); st.rerun()
                     with tab_l:
                         ll = st.text_input("URL"); ln = st.text_input("Nome"); desc_l = st.text_input("Descrição", key="dl")
                         if st.button("Adicionar Link"):
                             if ll and ln:
                                 conn = get_db_connection()
                                 conn.cursor().execute("INSERT INTO library_files (folder_id, name, type, link, description) VALUES (?,?,?,?,?)", (folder_id, ln, "link", ll, desc_l))
-                                conn.commit(); conn.close(); backup_to_drive(); st.success("Adicionado!"); st.rerun()
+                                conn.commit(); conn.close(); schedule_backup(); st.success("Adicionado!"); st.rerun()
                 
                 conn = get_db_connection()
-                lib_files = pd.read_sql_query("SELECT * FROM library_files WHERE folder_id=?", conn, params=(folder_id,))
+                lib_files = pd.read_sql_query("SELECT id, name, type, link, description, content_hash, content_size FROM library_files WHERE folder_id=?", conn, params=(folder_id,))
                 conn.close()
                 
                 if not lib_files.empty:
@@ -933,14 +2846,14 @@ def main_app():
                             lc1, lc2 = st.columns([5, 1])
                             with lc1:
                                 if lf['type'] == 'link': st.markdown(f"🔗 **[{lf['name']}]({lf['link']})**")
-                                else: st.markdown(f"📄 **{lf['name']}**")
+                                else: st.markdown(f"📄 **{lf['name']}** · {fmt_size(lf['content_size'])}")
                                 if lf['description']: st.caption(lf['description'])
                             with lc2:
-                                if lf['type'] == 'file': st.download_button("📥", lf['content'], file_name=lf['name'], key=f"lib_dl_{lf['id']}")
+                                if lf['type'] == 'file': blob_download_button("📥", lf['content_hash'], lf['name'], f"lib_dl_{lf['id']}")
                                 if st.button("🗑️", key=f"lib_del_{lf['id']}"):
                                     conn = get_db_connection()
                                     conn.cursor().execute("DELETE FROM library_files WHERE id=?", (lf['id'],))
-                                    conn.commit(); conn.close(); backup_to_drive(); st.rerun()
+                                    conn.commit(); conn.close(); schedule_backup(); schedule_blob_sweep(); st.rerun()
                 else: st.info("Esta pasta está vazia.")
             else: st.info("Cria e seleciona uma pasta para começar a organizar os teus documentos.")
 
@@ -971,7 +2884,7 @@ def main_app():
                     if st.form_submit_button("Guardar Relatório Geral"):
                         conn.cursor().execute("UPDATE sessions SET report=? WHERE id=?", (rt, int(sd['id'])))
                         conn.commit()
-                        backup_to_drive()
+                        schedule_backup()
                         st.success("Relatório Geral Guardado")
 
                 st.divider()
@@ -1015,14 +2928,16 @@ def main_app():
                                 nn = st.session_state[f"save_n_{gk['id']}"]
                                 
                                 # Verifica se já existe nota para fazer UPDATE ou INSERT
-                                exists = c.execute("SELECT id FROM training_ratings WHERE date=? AND gk_id=?", (d_str, gk['id'])).fetchone()
+                                exists = c.execute("SELECT id, rating FROM training_ratings WHERE date=? AND gk_id=?", (d_str, gk['id'])).fetchone()
                                 if exists:
                                     c.execute("UPDATE training_ratings SET rating=?, notes=? WHERE id=?", (nr, nn, exists[0]))
                                 else:
                                     c.execute("INSERT INTO training_ratings (user_id, date, gk_id, rating, notes) VALUES (?,?,?,?,?)", (user, d_str, gk['id'], nr, nn))
+                                update_rating_trend(c, user, int(gk['id']), d_str, old=exists[1] if exists else None, new=nr)
                             
                             conn.commit()
-                            backup_to_drive()
+                            bump_tables("rating_trends")
+                            schedule_backup()
                             st.success("Avaliações registadas com sucesso!")
                 else:
                     st.warning("⚠️ Ninguém marcado como 'Presente'. Vai a 'Gestão Semanal' > Planear Dias e marca as presenças primeiro.")
@@ -1033,7 +2948,7 @@ def main_app():
         # --- ABA 2: SEMANAL ---
         with t_sem:
             conn = get_db_connection()
-            micros = pd.read_sql_query("SELECT * FROM microcycles WHERE user_id=? ORDER BY start_date DESC", conn, params=(user,))
+            micros = cached_query("microcycles", ("microcycles",), "SELECT * FROM microcycles WHERE user_id=? ORDER BY start_date DESC", (user,))
             
             if not micros.empty:
                 # Cria a lista de opções para o menu
@@ -1066,7 +2981,8 @@ def main_app():
                         if st.form_submit_button("Guardar"): 
                             conn.cursor().execute("UPDATE microcycles SET report=? WHERE id=?", (mt, int(sel_m['id'])))
                             conn.commit()
-                            backup_to_drive()
+                            bump_tables("microcycles")
+                            schedule_backup()
                             st.success("Guardado!")
                 else:
                     st.warning("Erro a carregar semana. Por favor recarrega a página.")
@@ -1076,20 +2992,63 @@ def main_app():
     # --- 6. EVOLUÇÃO ---
     elif menu == "Evolução do Atleta":
         st.header("📈 Evolução")
-        conn = get_db_connection()
-        gks = pd.read_sql_query("SELECT id, name FROM goalkeepers WHERE user_id=?", conn, params=(user,))
-        conn.close()
+        gks = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
         if not gks.empty:
             sel_gk = st.selectbox("Atleta", gks['name'].tolist())
             gid = int(gks[gks['name']==sel_gk].iloc[0]['id'])
-            conn = get_db_connection()
-            hist = pd.read_sql_query("SELECT date, rating, notes FROM training_ratings WHERE user_id=? AND gk_id=? ORDER BY date ASC", conn, params=(user, gid))
-            conn.close()
-            if not hist.empty:
-                st.line_chart(hist.set_index("date")['rating'])
-                st.dataframe(hist, use_container_width=True)
-                st.metric("Média de Nota", f"{hist['rating'].mean():.1f}")
-            else: st.info("Sem dados de avaliação ainda.")
+            t_trein, t_jogos = st.tabs(["⭐ Treinos", "🏟️ Jogos"])
+            with t_trein:
+                series, bucket = rating_trend_series(user, gid)
+                if not series.empty:
+                    today = date.today()
+                    conn = get_db_connection()
+                    win = rating_windows(conn, gid, today)
+                    recent = pd.read_sql_query("SELECT date, rating, notes FROM training_ratings WHERE gk_id=? AND date > ? ORDER BY date DESC",
+                                               conn, params=(gid, (today - timedelta(days=max(RATING_WINDOWS))).strftime("%Y-%m-%d")))
+                    conn.close()
+                    fmt = lambda r: "-" if pd.isna(r['mean']) else f"{r['mean']:.1f}" + ("" if pd.isna(r['std']) else f" ± {r['std']:.1f}")
+                    cols = st.columns(len(RATING_WINDOWS) + 1)
+                    for col, days in zip(cols, RATING_WINDOWS):
+                        col.metric(f"Últimos {days} dias", fmt(win.loc[days]), help=f"{int(win.loc[days]['n'])} avaliações")
+                    overall = add_trend_stats(series[["n", "total", "total_sq"]].sum().to_frame().T).iloc[0]
+                    cols[-1].metric("Média de Nota", fmt(overall), help=f"{int(overall['n'])} avaliações")
+                    st.line_chart(series[["mean", "rolling"]].rename(columns={
+                        "mean": f"Média por {bucket}", "rolling": f"Média móvel ({RATING_ROLLING_BUCKETS} pontos)"}))
+                    micro = rating_micro_trends(user, gid)
+                    if not micro.empty:
+                        st.caption("Por microciclo")
+                        st.dataframe(micro[["title", "start_date", "n", "mean", "std"]].rename(columns={
+                            "title": "Semana", "start_date": "Início", "n": "Avaliações", "mean": "Média", "std": "Desvio"}).round(2),
+                            use_container_width=True, hide_index=True)
+                    st.caption(f"Avaliações dos últimos {max(RATING_WINDOWS)} dias")
+                    st.dataframe(recent, use_container_width=True)
+                else: st.info("Sem dados de avaliação ainda.")
+            with t_jogos:
+                ana = match_analytics(user)
+                if gid in ana.index.get_level_values("gk_id"):
+                    mine = ana.loc[gid]
+                    season = st.selectbox("Época", mine.index[::-1].tolist())
+                    r = mine.loc[season]
+                    m1, m2, m3, m4, m5 = st.columns(5)
+                    m1.metric("Jogos", int(r['games']))
+                    m2.metric("Minutos", int(r['match_duration']))
+                    m3.metric("% Defesas", "-" if pd.isna(r['save_pct']) else f"{r['save_pct']:.0f}%")
+                    m4.metric("Golos / 90'", f"{r['goals_conceded_p90']:.2f}")
+                    m5.metric("Nota Média", "-" if pd.isna(r['rating']) else f"{r['rating']:.1f}")
+                    labels = list(ACTION_FAMILY_LABELS.values())
+                    c1, c2 = st.columns(2)
+                    c1.caption("Ações por 90'")
+                    c1.bar_chart(pd.Series(r[[f"{f}_p90" for f in ACTION_FAMILY_LABELS]].values, index=labels, name="por 90'"))
+                    c2.caption("Distribuição das ações (%)")
+                    c2.bar_chart(pd.Series(r[[f"{f}_pct" for f in ACTION_FAMILY_LABELS]].fillna(0).values, index=labels, name="%"))
+                    st.caption("Perfil psicológico (média 1-10)")
+                    st.bar_chart(pd.Series(r[list(PSY_COLUMNS)].values, index=list(PSY_COLUMNS.values()), name="Média"))
+                    if len(mine) > 1:
+                        st.caption("Evolução por época")
+                        st.dataframe(mine[["games", "match_duration", "save_pct", "goals_conceded_p90", "rating"]].rename(columns={
+                            "games": "Jogos", "match_duration": "Minutos", "save_pct": "% Defesas",
+                            "goals_conceded_p90": "Golos/90'", "rating": "Nota"}).round(2), use_container_width=True)
+                else: st.info("Sem jogos registados para este atleta.")
         else: st.warning("Crie atletas primeiro.")
 
 
@@ -1100,11 +3059,11 @@ def main_app():
         # 1. ABRIR CONEXÃO (Fica aberta até ao fim deste bloco)
         conn = get_db_connection()
         
-        tab_new, tab_manage = st.tabs(["➕ Registrar Jogo", "⚙️ Gerir & Editar"])
+        tab_new, tab_manage, tab_cmp = st.tabs(["➕ Registrar Jogo", "⚙️ Gerir & Editar", "⚖️ Comparar Atletas"])
         
         # --- ABA 1: NOVO REGISTO ---
         with tab_new:
-            gks = pd.read_sql_query("SELECT id, name FROM goalkeepers WHERE user_id=?", conn, params=(user,))
+            gks = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
             
             with st.expander("Dados do Jogo (Geral)", expanded=True):
                 c1, c2, c3 = st.columns(3)
@@ -1255,58 +3214,51 @@ def main_app():
                     if st.form_submit_button("💾 Guardar Jogo"):
                         if not opponent: st.error("Falta adversário")
                         else:
-                            date_s = match_date.strftime("%Y-%m-%d"); c = conn.cursor()
-                            c.execute("DELETE FROM matches WHERE user_id=? AND date=? AND opponent=?", (user, date_s, opponent))
-                            for gid, d in inputs.items():
-                                vals = (user, date_s, opponent, gid, d['gls'], d['sav'], result, d['rep'], d['rat'], match_type, d['min'],
-                                        d['sh_faced'], d['sh_off'], d['psy_comm'], d['psy_dec'], d['psy_pos'], d['psy_res'],
-                                        d['b_sq_r'], d['b_sq_m'], d['b_sq_a'], d['b_cq_r'], d['b_cq_m'], d['b_cq_a'],
-                                        d['r_sq_m'], d['r_sq_a'], d['r_cq_r'], d['r_cq_m'], d['r_cq_a'], d['r_cq_v'],
-                                        d['d_sq_p'], d['d_sq_mf'], d['d_sq_ml'], d['d_sq_a1'], d['d_sq_a2'], d['d_cq_v'], d['d_cq_r1'], d['d_cq_r2'], d['d_cq_a1'], d['d_cq_a2'],
-                                        d['e_rec'], d['e_d1'], d['e_d2'], d['v_rec'], d['v_d1'], d['v_d2'], d['v_dmc'], d['de_cab'], d['de_car'], d['de_ali'], d['de_rec'], d['du_par'], d['du_aba'], d['du_est'], d['du_fro'], d['pa_c1'], d['pa_c2'], d['pa_l1'], d['pa_l2'], d['di_cm'], d['di_lm'], d['di_pm'], d['di_vo'], d['di_cp'], d['di_lp'], d['cr_rec'], d['cr_s1'], d['cr_s2'], d['cr_int'], d['eto_cur'], d['eto_med'], d['eto_lon'])
-                                c.execute(f'''INSERT INTO matches (id, user_id, date, opponent, gk_id, goals_conceded, saves, result, report, rating, match_type, match_duration,
-                                    shots_faced, shots_off_target, psy_comm, psy_decision, psy_posture, psy_resilience,
-                                    db_bloq_sq_rast, db_bloq_sq_med, db_bloq_sq_alt, db_bloq_cq_rast, db_bloq_cq_med, db_bloq_cq_alt,
-                                    db_rec_sq_med, db_rec_sq_alt, db_rec_cq_rast, db_rec_cq_med, db_rec_cq_alt, db_rec_cq_varr,
-                                    db_desv_sq_pe, db_desv_sq_mfr, db_desv_sq_mlat, db_desv_sq_a1, db_desv_sq_a2, db_desv_cq_varr, db_desv_cq_r1, db_desv_cq_r2, db_desv_cq_a1, db_desv_cq_a2,
-                                    db_ext_rec, db_ext_desv_1, db_ext_desv_2, db_voo_rec, db_voo_desv_1, db_voo_desv_2, db_voo_desv_mc,
-                                    de_cabeca, de_carrinho, de_alivio, de_rececao,
-                                    duelo_parede, duelo_abafo, duelo_estrela, duelo_frontal,
-                                    pa_curto_1, pa_curto_2, pa_longo_1, pa_longo_2, dist_curta_mao, dist_longa_mao, dist_picada_mao, dist_volley, dist_curta_pe, dist_longa_pe,
-                                    cruz_rec_alta, cruz_soco_1, cruz_soco_2, cruz_int_rast,
-                                    eto_pb_curto, eto_pb_medio, eto_pb_longo
-                                ) VALUES (NULL, {",".join(["?"]*len(vals))})''', vals)
-                            conn.commit(); backup_to_drive(); st.success("Jogo Gravado!"); st.rerun()
+                            date_s = match_date.strftime("%Y-%m-%d")
+                            lines = {gid: dict(zip(MATCH_LINE_COLUMNS, (d[k] for k in MATCH_FORM_KEYS))) for gid, d in inputs.items()}
+                            changes = save_match(conn, user, lines, header={"date": date_s, "opponent": opponent, "result": result, "match_type": match_type})
+                            bump_tables("matches", "match_actions"); schedule_backup(); st.success(f"Jogo Gravado! ({match_changes_text(changes)})"); st.rerun()
 
         # --- ABA 2: GERIR E EDITAR TOTALMENTE ---
         with tab_manage:
             st.subheader("📜 Histórico e Edição")
-            unique_games = pd.read_sql_query("SELECT DISTINCT date, opponent, result FROM matches WHERE user_id=? ORDER BY date DESC", conn, params=(user,))
+            games = pd.read_sql_query(f"""SELECT g.id, g.date, g.opponent, g.result, {GAME_SESSION_SQL} AS session_title
+                                          FROM games g WHERE g.user_id=? ORDER BY g.date DESC""", conn, params=(user,))
             
-            if not unique_games.empty:
-                game_opts = [f"{r['date']} | {r['opponent']} ({r['result']})" for _, r in unique_games.iterrows()]
-                sel_game_str = st.selectbox("Selecione um jogo:", game_opts)
+            if not games.empty:
+                game_labels = {int(r['id']): f"{r['date']} | {r['opponent']} ({r['result']})" for _, r in games.iterrows()}
+                sel_match_id = st.selectbox("Selecione um jogo:", list(game_labels), format_func=game_labels.get)
                 
-                if sel_game_str:
-                    sel_date = sel_game_str.split(" | ")[0]
-                    sel_opp = sel_game_str.split(" | ")[1].split(" (")[0]
+                if sel_match_id:
+                    sel_game = games[games['id'] == sel_match_id].iloc[0]
+                    sel_date, sel_opp = sel_game['date'], sel_game['opponent']
+                    if sel_game['session_title']: st.caption(f"🔗 Sessão no calendário: {sel_game['session_title']}")
                     
                     # Editar Metadados
                     with st.expander("✏️ Editar Detalhes Gerais (Data/Adversário)", expanded=False):
                         with st.form("edit_meta"):
                             c1, c2, c3 = st.columns(3)
                             nd = c1.date_input("Nova Data", datetime.strptime(sel_date, "%Y-%m-%d"))
-                            no = c2.text_input("Novo Adv.", sel_opp); nr = c3.text_input("Novo Res.", sel_game_str.split("(")[1].replace(")",""))
+                            no = c2.text_input("Novo Adv.", sel_opp); nr = c3.text_input("Novo Res.", sel_game['result'] or "")
                             if st.form_submit_button("Atualizar Geral"):
-                                conn.cursor().execute("UPDATE matches SET date=?, opponent=?, result=? WHERE user_id=? AND date=? AND opponent=?", (nd.strftime("%Y-%m-%d"), no, nr, user, sel_date, sel_opp))
-                                conn.commit(); backup_to_drive(); st.success("Atualizado!"); st.rerun()
+                                try:
+                                    update_match_header(conn, user, sel_match_id, nd.strftime("%Y-%m-%d"), no, nr)
+                                except sqlite3.IntegrityError:
+                                    st.error("Já existe um jogo com essa data e adversário.")
+                                else:
+                                    bump_tables("matches"); schedule_backup(); st.success("Atualizado!"); st.rerun()
 
                     # Lista de Atletas no Jogo para EDIÇÃO TOTAL
                     st.write("---")
                     st.write(f"**Atletas em: {sel_opp}**")
                     
-                    rows = pd.read_sql_query("SELECT * FROM matches WHERE user_id=? AND date=? AND opponent=?", conn, params=(user, sel_date, sel_opp))
-                    gks_ref = pd.read_sql_query("SELECT id, name FROM goalkeepers", conn) 
+                    rows = match_lines_frame(conn, sel_match_id)
+                    gks_ref = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
+                    fam = action_family_totals(user, sel_match_id)
+                    if not fam.empty:
+                        st.caption("Ações técnicas por família")
+                        fam.index = fam.index.map(dict(zip(gks_ref['id'], gks_ref['name'])))
+                        st.dataframe(fam.rename(columns=ACTION_FAMILY_LABELS), use_container_width=True)
                     
                     for _, row in rows.iterrows():
                         # Nome do GR
@@ -1440,47 +3392,57 @@ def main_app():
 
                                 c_upd, c_del = st.columns([3, 1])
                                 if c_upd.form_submit_button("💾 Atualizar Ficha Individual"):
-                                    # UPDATE GIGANTE COM TUDO
-                                    conn.cursor().execute("""
-                                        UPDATE matches SET 
-                                            match_duration=?, goals_conceded=?, saves=?, rating=?, report=?,
-                                            shots_faced=?, shots_off_target=?, 
-                                            psy_comm=?, psy_decision=?, psy_posture=?, psy_resilience=?, 
-                                            db_bloq_sq_rast=?, db_bloq_sq_med=?, db_bloq_sq_alt=?, db_bloq_cq_rast=?, db_bloq_cq_med=?, db_bloq_cq_alt=?,
-                                            db_rec_sq_med=?, db_rec_sq_alt=?, db_rec_cq_rast=?, db_rec_cq_med=?, db_rec_cq_alt=?, db_rec_cq_varr=?,
-                                            db_desv_sq_pe=?, db_desv_sq_mfr=?, db_desv_sq_mlat=?, db_desv_sq_a1=?, db_desv_sq_a2=?, 
-                                            db_desv_cq_varr=?, db_desv_cq_r1=?, db_desv_cq_r2=?, db_desv_cq_a1=?, db_desv_cq_a2=?,
-                                            db_ext_rec=?, db_ext_desv_1=?, db_ext_desv_2=?, db_voo_rec=?, db_voo_desv_1=?, db_voo_desv_2=?, db_voo_desv_mc=?,
-                                            de_cabeca=?, de_carrinho=?, de_alivio=?, de_rececao=?,
-                                            duelo_parede=?, duelo_abafo=?, duelo_estrela=?, duelo_frontal=?,
-                                            pa_curto_1=?, pa_curto_2=?, pa_longo_1=?, pa_longo_2=?, 
-                                            dist_curta_mao=?, dist_longa_mao=?, dist_picada_mao=?, dist_volley=?, dist_curta_pe=?, dist_longa_pe=?,
-                                            cruz_rec_alta=?, cruz_soco_1=?, cruz_soco_2=?, cruz_int_rast=?,
-                                            eto_pb_curto=?, eto_pb_medio=?, eto_pb_longo=?
-                                        WHERE id=?""", 
-                                        (e_min, e_gls, e_sav, e_rat, e_rep,
-                                         e_sf, e_so, ep_c, ep_d, ep_p, ep_r,
-                                         e_bsqr, e_bsqm, e_bsqa, e_bcqr, e_bcqm, e_bcqa,
-                                         e_rsqm, e_rsqa, e_rcqr, e_rcqm, e_rcqa, e_rcqv,
-                                         e_dsqp, e_dsqmf, e_dsqml, e_dsqa1, e_dsqa2,
-                                         e_dcqv, e_dcqr1, e_dcqr2, e_dcqa1, e_dcqa2,
-                                         e_erec, e_ed1, e_ed2, e_vrec, e_vd1, e_vd2, e_vdmc,
-                                         e_decab, e_decar, e_deali, e_derec,
-                                         e_dupar, e_duaba, e_duest, e_dufro,
-                                         e_pac1, e_pac2, e_pal1, e_pal2,
-                                         e_dicm, e_dilm, e_dipm, e_divo, e_dicp, e_dilp,
-                                         e_crrec, e_crs1, e_crs2, e_crint,
-                                         e_etoc, e_etom, e_etol,
-                                         row['id']))
-                                    conn.commit(); backup_to_drive(); st.success("Atualizado!"); st.rerun()
+                                    line = {"match_duration": e_min, "goals_conceded": e_gls, "saves": e_sav, "rating": e_rat, "report": e_rep,
+                                            "shots_faced": e_sf, "shots_off_target": e_so,
+                                            "psy_comm": ep_c, "psy_decision": ep_d, "psy_posture": ep_p, "psy_resilience": ep_r}
+                                    line.update(zip(MATCH_TECH_COLUMNS, (
+                                        e_bsqr, e_bsqm, e_bsqa, e_bcqr, e_bcqm, e_bcqa,
+                                        e_rsqm, e_rsqa, e_rcqr, e_rcqm, e_rcqa, e_rcqv,
+                                        e_dsqp, e_dsqmf, e_dsqml, e_dsqa1, e_dsqa2,
+                                        e_dcqv, e_dcqr1, e_dcqr2, e_dcqa1, e_dcqa2,
+                                        e_erec, e_ed1, e_ed2, e_vrec, e_vd1, e_vd2, e_vdmc,
+                                        e_decab, e_decar, e_deali, e_derec,
+                                        e_dupar, e_duaba, e_duest, e_dufro,
+                                        e_pac1, e_pac2, e_pal1, e_pal2,
+                                        e_dicm, e_dilm, e_dipm, e_divo, e_dicp, e_dilp,
+                                        e_crrec, e_crs1, e_crs2, e_crint,
+                                        e_etoc, e_etom, e_etol)))
+                                    changes = save_match(conn, user, {int(row['gk_id']): line}, match_id=sel_match_id, replace=False)
+                                    if changes["updated"]: bump_tables("matches", "match_actions"); schedule_backup(); st.success("Atualizado!"); st.rerun()
+                                    else: st.info("Sem alterações.")
                                 
                                 if c_del.form_submit_button("🗑️ Remover Atleta do Jogo"):
-                                    conn.cursor().execute("DELETE FROM matches WHERE id=?", (row['id'],))
-                                    conn.commit(); backup_to_drive(); st.warning("Removido."); st.rerun()
+                                    delete_match_line(conn, user, int(row['id']))
+                                    bump_tables("matches", "match_actions"); schedule_backup(); st.warning("Removido."); st.rerun()
                     st.divider()
                     if st.button("🗑️ APAGAR JOGO COMPLETO", type="primary"):
-                        conn.cursor().execute("DELETE FROM matches WHERE user_id=? AND date=? AND opponent=?", (user, sel_date, sel_opp))
-                        conn.commit(); backup_to_drive(); st.warning("Jogo apagado."); st.rerun()
+                        delete_match(conn, user, sel_match_id)
+                        bump_tables("matches", "match_actions"); schedule_backup(); st.warning("Jogo apagado."); st.rerun()
+            else:
+                st.info("Sem jogos.")
+
+        # --- ABA 3: COMPARAÇÃO ---
+        with tab_cmp:
+            st.subheader("⚖️ Comparação entre Guarda-Redes")
+            ana = match_analytics(user)
+            if not ana.empty:
+                pct = match_percentiles(user)
+                gks_cmp = cached_query("goalkeepers", ("goalkeepers",), "SELECT id, name, status FROM goalkeepers WHERE user_id=?", (user,))
+                gk_names = dict(zip(gks_cmp['id'], gks_cmp['name']))
+                seasons = sorted(ana.index.get_level_values("season").unique(), reverse=True)
+                season = st.selectbox("Época", seasons, key="cmp_season")
+                in_season = ana.xs(season, level="season")
+                sel_ids = st.multiselect("Atletas", in_season.index.tolist(), default=in_season.index.tolist()[:2],
+                                         format_func=lambda i: gk_names.get(i, "Desconhecido"))
+                if sel_ids:
+                    vals = in_season.loc[sel_ids, list(PERCENTILE_STATS)]
+                    ranks = pct.xs(season, level="season").loc[sel_ids, list(PERCENTILE_STATS)]
+                    table = pd.DataFrame({gk_names.get(i, str(i)): [f"{v:.1f}  (P{p:.0f})" if pd.notna(v) else "-"
+                                                                    for v, p in zip(vals.loc[i], ranks.loc[i])]
+                                          for i in sel_ids}, index=list(PERCENTILE_STATS.values()))
+                    st.caption(f"Valor e percentil dentro do plantel na época {season} ({len(in_season)} atletas com jogos)")
+                    st.dataframe(table, use_container_width=True)
+                    st.bar_chart(ranks.T.rename(index=PERCENTILE_STATS, columns=lambda i: gk_names.get(i, str(i))))
             else:
                 st.info("Sem jogos.")
         
@@ -1515,9 +3477,7 @@ def main_app():
     elif menu == "Meus Atletas":
         st.header("📋 Plantel")
         mode = st.radio("Opções", ["Novo", "Editar", "Eliminar"], horizontal=True)
-        conn = get_db_connection()
-        all_gks = pd.read_sql_query("SELECT * FROM goalkeepers WHERE user_id=?", conn, params=(user,))
-        conn.close()
+        all_gks = cached_query("goalkeepers (ficha)", ("goalkeepers",), "SELECT * FROM goalkeepers WHERE user_id=?", (user,))
         
         tab_perf, tab_med = st.tabs(["👤 Perfil & Dados", "🏥 Departamento Médico"])
         
@@ -1542,7 +3502,8 @@ def main_app():
                     conn = get_db_connection()
                     conn.cursor().execute("DELETE FROM goalkeepers WHERE id=?", (e_id,))
                     conn.commit(); conn.close()
-                    backup_to_drive()
+                    bump_tables("goalkeepers")
+                    schedule_backup()
                     st.success("Apagado"); st.rerun()
             
             elif mode!="Eliminar":
@@ -1582,7 +3543,8 @@ def main_app():
                             c.execute('''UPDATE goalkeepers SET name=?, age=?, status=?, height=?, wingspan=?, arm_len_left=?, arm_len_right=?, glove_size=?, jump_front_2=?, jump_front_l=?, jump_front_r=?, jump_lat_l=?, jump_lat_r=?, test_res=?, test_agil=?, test_vel=? WHERE id=?''', 
                                       (nm, ag, stt, ht, ws, al, ar, gl, jf2, jfl, jfr, jll, jlr, tr, ta, tv, e_id))
                         conn.commit(); conn.close()
-                        backup_to_drive()
+                        bump_tables("goalkeepers")
+                        schedule_backup()
                         st.success("Guardado"); st.rerun()
             st.dataframe(all_gks.drop(columns=['user_id', 'notes']), use_container_width=True)
 
@@ -1600,7 +3562,7 @@ def main_app():
                             conn = get_db_connection(); c = conn.cursor()
                             c.execute("INSERT INTO injuries (gk_id, injury_date, recovery_weeks, description, active) VALUES (?,?,?,?,1)", (gid_med, di, rw, desc))
                             c.execute("UPDATE goalkeepers SET status='Lesionado' WHERE id=?", (gid_med,))
-                            conn.commit(); conn.close(); backup_to_drive(); st.success("Lesão registada!"); st.rerun()
+                            conn.commit(); conn.close(); bump_tables("goalkeepers"); schedule_backup(); st.success("Lesão registada!"); st.rerun()
                 
                 conn = get_db_connection()
                 active = pd.read_sql_query("SELECT * FROM injuries WHERE gk_id=? AND active=1", conn, params=(gid_med,))
@@ -1618,7 +3580,7 @@ def main_app():
                             c.execute("UPDATE injuries SET active=0 WHERE id=?", (inj['id'],))
                             others = c.execute("SELECT count(*) FROM injuries WHERE gk_id=? AND active=1", (gid_med,)).fetchone()[0]
                             if others == 0: c.execute("UPDATE goalkeepers SET status='Apto' WHERE id=?", (gid_med,))
-                            conn.commit(); conn.close(); backup_to_drive(); st.success("Recuperado!"); st.rerun()
+                            conn.commit(); conn.close(); bump_tables("goalkeepers"); schedule_backup(); st.success("Recuperado!"); st.rerun()
                 else:
                     st.success(f"{sel_gk_med} está Apto.")
                 
@@ -1632,9 +3594,7 @@ def main_app():
     elif menu == "Exercícios":
         st.header("⚽ Biblioteca Técnica")
         if 'edit_drill_id' not in st.session_state: st.session_state['edit_drill_id'] = None
-        conn = get_db_connection()
-        all_ex = pd.read_sql_query("SELECT * FROM exercises WHERE user_id=?", conn, params=(user,))
-        conn.close()
+        all_ex = cached_query("exercises", ("exercises",), "SELECT id, title, moment, training_type, description, objective, materials, space, image_hash FROM exercises WHERE user_id=?", (user,))
         
         d_tit, d_mom, d_typ, d_desc, d_obj, d_mat, d_spa = "", "Defesa de Baliza", "Técnico", "", "", "", ""
         if st.session_state['edit_drill_id'] and not all_ex.empty:
@@ -1662,24 +3622,29 @@ def main_app():
             materials = c4.text_area("Material", value=d_mat, height=100)
             
             desc = st.text_area("Descrição", value=d_desc, height=150)
-            img = st.file_uploader("Imagem do Exercício (Upload)", type=['png','jpg'])
+            img = st.file_uploader("Imagem do Exercício (Upload)", type=['png','jpg','jpeg','webp'])
             
             if st.form_submit_button("Guardar"):
-                b_img = img.read() if img else None
+                img_hash, img_size = put_blob(normalize_image(img.read())) if img else (None, None)
                 conn = get_db_connection()
                 c = conn.cursor()
+                replaced_img = bool(img_hash and st.session_state['edit_drill_id'])
                 if not st.session_state['edit_drill_id']:
-                    c.execute('''INSERT INTO exercises (user_id, title, moment, training_type, description, objective, materials, space, image) 
-                                 VALUES (?,?,?,?,?,?,?,?,?)''', (user, title, moment, train_type, desc, objective, materials, space, b_img))
+                    c.execute('''INSERT INTO exercises (user_id, title, moment, training_type, description, objective, materials, space, image_hash, image_size) 
+                                 VALUES (?,?,?,?,?,?,?,?,?,?)''', (user, title, moment, train_type, desc, objective, materials, space, img_hash, img_size))
+                    eid = c.lastrowid
                     st.success("Criado!")
                 else:
                     eid = st.session_state['edit_drill_id']
-                    if b_img: c.execute('''UPDATE exercises SET title=?, moment=?, training_type=?, description=?, objective=?, materials=?, space=?, image=? WHERE id=?''', (title, moment, train_type, desc, objective, materials, space, b_img, eid))
+                    if img_hash: c.execute('''UPDATE exercises SET title=?, moment=?, training_type=?, description=?, objective=?, materials=?, space=?, image_hash=?, image_size=? WHERE id=?''', (title, moment, train_type, desc, objective, materials, space, img_hash, img_size, eid))
                     else: c.execute('''UPDATE exercises SET title=?, moment=?, training_type=?, description=?, objective=?, materials=?, space=? WHERE id=?''', (title, moment, train_type, desc, objective, materials, space, eid))
                     st.success("Atualizado!")
                     st.session_state['edit_drill_id'] = None
                 conn.commit(); conn.close()
-                backup_to_drive()
+                if img_hash: get_thumbnail(eid, img_hash)
+                bump_tables("exercises")
+                schedule_backup()
+                if replaced_img: schedule_blob_sweep("imagem substituída")
                 st.success("Guardado!"); st.rerun()
 
         st.markdown("---")
@@ -1699,13 +3664,20 @@ def main_app():
                                         conn = get_db_connection()
                                         conn.cursor().execute("DELETE FROM exercises WHERE id=?", (r['id'],))
                                         conn.commit(); conn.close()
-                                        backup_to_drive()
+                                        bump_tables("exercises")
+                                        schedule_backup(); schedule_blob_sweep()
                                         st.rerun()
                                 with c_txt:
                                     st.write(f"**Obj:** {r['objective']}"); st.write(f"**Mat:** {r['materials']}")
                                     st.caption(r['description'])
                                 with c_img:
-                                    if r['image']: st.image(r['image'])
+                                    if r['image_hash']:
+                                        thumb = get_thumbnail(r['id'], r['image_hash'])
+                                        if thumb: st.image(thumb)
+                                        if st.button("🔍 Ver imagem", key=f"full_{r['id']}"):
+                                            st.session_state['full_img_id'] = None if st.session_state.get('full_img_id') == r['id'] else r['id']
+                                if r['image_hash'] and st.session_state.get('full_img_id') == r['id']:
+                                    st.image(get_blob(r['image_hash']))
                     else: st.info("Vazio.")
         else:
             for t in tabs: t.info("Vazio.")
@@ -1713,28 +3685,95 @@ def main_app():
     # --- 11. BACKUPS & DADOS ---
     elif menu == "💾 Backups & Dados":
         st.header("💾 Centro de Recuperação e Segurança")
-        st.info("O sistema tenta sincronizar automaticamente com o Google Drive ao guardar dados.")
+        st.info(f"O sistema agrupa as alterações e sincroniza com o Google Drive {BACKUP_WINDOW_S}s depois da primeira (ou ao sair).")
         
         tab_drive, tab_down, tab_up = st.tabs(["☁️ Estado do Drive", "⬇️ Download PC", "⬆️ Restaurar Manual"])
         
         with tab_drive:
             st.write("Forçar sincronização manual com o Google Drive:")
             if st.button("📤 Enviar Backup para o Drive Agora"):
-                with st.spinner("A enviar..."):
-                    backup_to_drive()
+                flush_backup("manual")
+                st.success("Backup colocado em fila de envio.")
+
+            worker = get_upload_worker()
+            st.markdown("###### 📡 Envio em Segundo Plano")
+            if worker.current:
+                st.progress(worker.progress, text=f"A enviar ({worker.current})... {worker.progress*100:.0f}%")
+            else:
+                st.caption("Sem envios em curso.")
+            c_w1, c_w2, c_w3 = st.columns(3)
+            c_w1.metric("Último Backup OK", worker.last_success.strftime("%d/%m %H:%M:%S") if worker.last_success else "--")
+            c_w2.metric("Jobs na Outbox", worker.outbox.pending())
+            if worker.last_error:
+                c_w3.error(f"Último erro ({worker.last_error[0].strftime('%d/%m %H:%M')}): {worker.last_error[1]}")
+            jobs = worker.outbox.jobs()
+            if not jobs.empty:
+                st.dataframe(jobs.rename(columns={"kind": "Tipo", "target": "Alvo", "reason": "Motivo", "writes": "Escritas",
+                                                  "attempts": "Tentativas", "next_attempt": "Próxima Tentativa", "last_error": "Último Erro"}),
+                             use_container_width=True)
             
+            sched = get_backup_scheduler(current_db_file())
+            st.markdown("###### ⏱️ Backups Agrupados")
+            c_b1, c_b2, c_b3 = st.columns(3)
+            c_b1.metric("Alterações Pendentes", worker.outbox.pending_writes("backup", current_db_file()))
+            c_b2.metric("Janela (s)", sched.window_s)
+            c_b3.metric("Último Envio", sched.last_flush.strftime("%H:%M:%S") if sched.last_flush else "--:--")
+            if sched.history:
+                st.dataframe(pd.DataFrame(sched.history, columns=["Data", "Motivo", "Escritas Agrupadas", "Sucesso"]), use_container_width=True)
+            else:
+                st.caption("Ainda não houve envios nesta sessão do servidor.")
+
+            st.markdown("###### 🧠 Cache de Consultas")
+            qstats = get_query_cache().stats_frame()
+            if not qstats.empty:
+                st.dataframe(qstats, use_container_width=True, hide_index=True)
+            else:
+                st.caption("Ainda sem leituras em cache.")
+
+            st.markdown("###### 🧮 Resumo de KPIs (Dashboard)")
+            if st.button("🔁 Recalcular Resumo a partir dos Jogos"):
+                conn = get_db_connection()
+                try:
+                    changed = rebuild_match_kpis(conn.cursor(), user)
+                    conn.commit()
+                finally:
+                    conn.close()
+                if changed:
+                    st.warning("O resumo guardado estava diferente dos jogos e foi corrigido.")
+                else:
+                    st.success("Resumo consistente com os jogos.")
+
+            st.markdown("###### 🧹 Ficheiros sem uso")
+            st.caption(f"Imagens e documentos que nenhum registo usa há mais de {BLOB_GC_GRACE_DAYS} dias são apagados daqui e do Drive.")
+            if st.button("🧹 Limpar Ficheiros Órfãos"):
+                schedule_blob_sweep("manual")
+                st.success("Limpeza agendada (corre em segundo plano).")
+
             if st.button("📥 Baixar Backup do Drive (Substitui Local)"):
                 with st.spinner("A baixar..."):
-                    sync_download_db()
-                    st.success("Sincronizado! A reiniciar..."); st.rerun()
+                    if sync_download_db(current_db_file(), force=True):
+                        check_db_updates(current_db_file())
+                        st.success("Sincronizado! A reiniciar..."); st.rerun()
+                    else:
+                        st.info("A base de dados local já é igual à do Drive.")
 
         with tab_down:
             st.write("Guardar cópia local no PC:")
-            if os.path.exists(DB_FILE):
-                with open(DB_FILE, "rb") as fp:
+            if os.path.exists(current_db_file()):
+                if st.button("📸 Preparar Cópia Consistente"):
+                    # Snapshot pela API de backup: nunca apanha uma escrita a meio
+                    with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as tf:
+                        snap = tf.name
+                    try:
+                        snapshot_db(snap, current_db_file())
+                        with open(snap, "rb") as fp:
+                            st.session_state['db_snapshot'] = fp.read()
+                    finally:
+                        os.unlink(snap)
+                if st.session_state.get('db_snapshot'):
                     st.download_button(
                         label="📥 Download Base de Dados (.db)",
-                        data=fp,
+                        data=st.session_state['db_snapshot'],
                         file_name=f"backup_gk_manager_{datetime.now().strftime('%Y%m%d_%H%M')}.db",
                         mime="application/x-sqlite3"
                     )
@@ -1745,7 +3784,13 @@ def main_app():
             uploaded_db = st.file_uploader("Carregar ficheiro .db", type=['db'])
             if uploaded_db is not None:
                 if st.button("⚠️ Confirmar Restauro"):
-                    with open(DB_FILE, "wb") as f: f.write(uploaded_db.getbuffer())
+                    db_dir = os.path.dirname(os.path.abspath(current_db_file()))
+                    with tempfile.NamedTemporaryFile(dir=db_dir, prefix=".restore_", suffix=".db", delete=False) as f:
+                        f.write(uploaded_db.getbuffer())
+                    replace_db_file(f.name, current_db_file())
+                    # Cópias antigas podem vir com um esquema anterior (ex.: bytes ainda nas tabelas)
+                    check_db_updates(current_db_file())
+                    schedule_backup()
                     st.success("Restaurado! A reiniciar..."); st.rerun()
 
 if st.session_state['logged_in']:
@@ -0,0 +1,61 @@
+"""Backups agrupados na outbox em disco: uma escrita não se perde se o processo reiniciar."""
+import os
+import sqlite3
+
+import pytest
+
+from conftest import load_app
+
+
+def start_process(tmp_path):
+    """Um processo novo: namespace e worker acabados de criar sobre a mesma outbox em disco."""
+    app = load_app()
+    app["OUTBOX_FILE"] = str(tmp_path / "gk_sync_outbox.db")
+    app["BACKUP_WINDOW_S"] = 3600
+    app["drive_enabled"] = lambda: True
+    app["get_drive_service"] = lambda: object()
+    # Sem corrida com a thread: os jobs ficam na outbox, como num processo que ainda não os correu
+    idle = type("IdleWorker", (app["UploadWorker"],), {"_run": lambda self: None})
+    worker = idle(app["UPLOAD_QUEUE_SIZE"], app["SyncOutbox"](app["OUTBOX_FILE"]))
+    app["get_upload_worker"] = lambda: worker
+    return app
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / "gk_master.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE goalkeepers (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_debounced_writes_share_one_durable_job(tmp_path, db_file):
+    app = start_process(tmp_path)
+    app["schedule_backup"](db_file)
+    app["schedule_backup"](db_file)
+
+    jobs = app["get_upload_worker"]().outbox.jobs()
+    assert len(jobs) == 1 and jobs.loc[0, "writes"] == 2
+    assert app["get_upload_worker"]().outbox.next_due() is None  # só corre no fim da janela
+
+
+def test_restart_keeps_debounced_write_ahead_of_drive(tmp_path, db_file):
+    app = start_process(tmp_path)
+    app["schedule_backup"](db_file)
+    before = os.stat(db_file).st_mtime_ns
+
+    app = start_process(tmp_path)  # o processo reinicia antes do fim da janela
+    assert app["local_db_ahead"](db_file)
+    assert app["sync_download_db"](db_file) is False
+    assert os.stat(db_file).st_mtime_ns == before
+
+
+def test_logout_flush_runs_the_scheduled_backup_now(tmp_path, db_file):
+    app = start_process(tmp_path)
+    app["schedule_backup"](db_file)
+    app["flush_backup"]("logout", db_file)
+
+    job = app["get_upload_worker"]().outbox.next_due()
+    assert job["target"] == db_file and job["writes"] == 1
@@ -0,0 +1,66 @@
+"""Limpeza dos blobs que nenhuma DB refere (sweep_blobs)."""
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def store_app(app, tmp_path):
+    app["DB_FILE"] = str(tmp_path / "gk_master.db")
+    app["BLOB_DB_FILE"] = str(tmp_path / "gk_blobs.db")
+    app["STORAGE_MODE"] = "shared"
+    app["drive_enabled"] = lambda: False
+    app["current_db_file"] = lambda: app["DB_FILE"]
+    init_store = app["init_blob_store"]
+    app["init_blob_store"] = lambda db_file=None: init_store(db_file or app["BLOB_DB_FILE"])
+    conn = sqlite3.connect(app["DB_FILE"])
+    app["migrate_db"](conn)
+    conn.close()
+    return app
+
+
+def age(app, hashes, days):
+    """Recua a criação e as marcas dos blobs `days` dias."""
+    old = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    conn = sqlite3.connect(app["BLOB_DB_FILE"])
+    for h in hashes:
+        conn.execute("UPDATE blobs SET created=? WHERE hash=?", (old, h))
+        conn.execute("UPDATE blob_refs SET last_seen=? WHERE hash=?", (old, h))
+    conn.commit()
+    conn.close()
+
+
+def stored(app):
+    conn = sqlite3.connect(app["BLOB_DB_FILE"])
+    try:
+        return {r[0] for r in conn.execute("SELECT hash FROM blobs")}
+    finally:
+        conn.close()
+
+
+def test_sweep_removes_only_unreferenced_blobs_past_grace(store_app):
+    app = store_app
+    used, _ = app["put_blob"](b"imagem em uso")
+    dropped, _ = app["put_blob"](b"imagem apagada")
+    recent, _ = app["put_blob"](b"apagada agora")
+    conn = sqlite3.connect(app["DB_FILE"])
+    conn.execute("INSERT INTO exercises (user_id, title, image_hash) VALUES ('ana', 'Saídas', ?)", (used,))
+    conn.commit()
+    conn.close()
+    age(app, [used, dropped], app["BLOB_GC_GRACE_DAYS"] + 1)
+
+    deleted, freed = app["sweep_blobs"]()
+
+    assert (deleted, freed) == (1, len(b"imagem apagada"))
+    assert stored(app) == {used, recent}
+
+
+def test_sweep_keeps_claims_of_dbs_not_on_this_server(store_app, tmp_path):
+    app = store_app
+    h, _ = app["put_blob"](b"documento de outro treinador", db_file=str(tmp_path / "gk_user_rui.db"))
+    age(app, [h], app["BLOB_GC_GRACE_DAYS"] + 1)
+    app["known_db_files"] = lambda: [app["DB_FILE"], str(tmp_path / "gk_user_rui.db")]
+
+    assert app["sweep_blobs"]() == (0, 0)
+    assert stored(app) == {h}
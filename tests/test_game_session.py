@@ -0,0 +1,23 @@
+"""Sessão do calendário de cada jogo, resolvida na leitura."""
+import sqlite3
+
+
+def session_titles(app, conn):
+    return conn.execute(f"SELECT g.opponent, {app['GAME_SESSION_SQL']} FROM games g ORDER BY g.id").fetchall()
+
+
+def test_game_session_follows_planner_changes(app, tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "gk_master.db"))
+    app["migrate_db"](conn)
+    c = conn.cursor()
+    assert "session_id" not in app["table_columns"](c, "games")
+    app["upsert_game"](c, "ana", {"date": "2025-03-01", "opponent": "Porto"})
+    assert session_titles(app, conn) == [("Porto", None)]
+
+    # A sessão é criada depois do jogo e mais tarde muda de dia no planeador
+    c.execute("INSERT INTO sessions (id, user_id, type, title, start_date) VALUES (1, 'ana', 'Jogo', 'vs Porto', '2025-03-01')")
+    assert session_titles(app, conn) == [("Porto", "vs Porto")]
+    c.execute("UPDATE sessions SET start_date='2025-03-02' WHERE id=1")
+    assert session_titles(app, conn) == [("Porto", None)]
+    conn.close()
+
@@ -0,0 +1,30 @@
+"""Chave única (jogo, guarda-redes): os duplicados antigos não se perdem na migração."""
+import os
+import shutil
+import sqlite3
+
+LEGACY_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gk_master_v35.db")
+
+
+def test_duplicate_lines_are_kept_in_matches_dupes(app, tmp_path):
+    db_file = str(tmp_path / "gk_master.db")
+    shutil.copyfile(LEGACY_TEMPLATE, db_file)
+    conn = sqlite3.connect(db_file)
+    conn.execute("""INSERT INTO matches (id, user_id, date, opponent, gk_id, goals_conceded, saves, db_bloq_sq_rast)
+                    VALUES (1, 'ana', '2025-03-01', 'Porto', 1, 2, 3, 9), (2, 'ana', '2025-03-01', 'Porto', 1, 1, 4, 2),
+                           (3, 'ana', '2025-03-08', 'Braga', 1, 0, 5, 1)""")
+    conn.commit()
+
+    app["migrate_db"](conn)
+
+    assert [r[0] for r in conn.execute("SELECT id FROM matches ORDER BY id")] == [2, 3]
+    kept = conn.execute("SELECT id, goals_conceded, saves, db_bloq_sq_rast FROM matches_dupes").fetchall()
+    assert kept == [(1, 2, 3, 9)]
+    conn.close()
+
+
+def test_no_dupes_table_without_duplicates(app, tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "gk_master.db"))
+    app["migrate_db"](conn)
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name='matches_dupes'").fetchone() is None
+    conn.close()
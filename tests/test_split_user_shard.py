@@ -0,0 +1,70 @@
+"""Separação da DB única (esquema antigo) para a shard de um treinador."""
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+LEGACY_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gk_master_v35.db")
+
+
+@pytest.fixture
+def legacy_app(app, tmp_path):
+    legacy = str(tmp_path / "gk_master.db")
+    shutil.copyfile(LEGACY_TEMPLATE, legacy)
+    app["DB_FILE"] = legacy
+    return app
+
+
+def add_legacy_rows(db_file):
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    c.execute("INSERT INTO goalkeepers (id, user_id, name) VALUES (1, 'ana', 'GR Ana'), (2, 'rui', 'GR Rui')")
+    # Mesmo jogo e guarda-redes gravado duas vezes: fica a linha mais recente
+    c.execute("""INSERT INTO matches (id, user_id, date, opponent, gk_id, goals_conceded, saves, result, db_bloq_sq_rast, cruz_soco_1)
+                 VALUES (1, 'ana', '2025-03-01', 'Porto', 1, 2, 3, '1-2', 9, 9)""")
+    c.execute("""INSERT INTO matches (id, user_id, date, opponent, gk_id, goals_conceded, saves, result, db_bloq_sq_rast, cruz_soco_1, eto_pb_curto)
+                 VALUES (2, 'ana', '2025-03-01', 'Porto', 1, 1, 4, '1-2', 2, 0, 1)""")
+    c.execute("""INSERT INTO matches (id, user_id, date, opponent, gk_id, goals_conceded, saves, result, dist_volley)
+                 VALUES (3, 'rui', '2025-03-08', 'Braga', 2, 0, 5, '2-0', 4)""")
+    conn.commit()
+    conn.close()
+
+
+def test_split_migrates_legacy_actions_and_duplicates(legacy_app, tmp_path):
+    app = legacy_app
+    add_legacy_rows(app["DB_FILE"])
+    shard = str(tmp_path / "gk_user_ana.db")
+    app["split_user_shard"]("ana", shard)
+
+    conn = sqlite3.connect(shard)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == app["SCHEMA_VERSION"]
+    lines = conn.execute("SELECT id, gk_id, goals_conceded, saves, match_id FROM matches").fetchall()
+    assert len(lines) == 1 and lines[0][:4] == (2, 1, 1, 4)
+    assert conn.execute("SELECT date, opponent FROM games WHERE id=?", (lines[0][4],)).fetchone() == ("2025-03-01", "Porto")
+    actions = dict(conn.execute("SELECT code, count FROM match_actions WHERE line_id=2").fetchall())
+    assert actions == {"db_bloq_sq_rast": 2, "eto_pb_curto": 1}
+    assert conn.execute("SELECT count(*) FROM match_actions").fetchone()[0] == 2
+    assert conn.execute("SELECT games, goals_conceded, saves FROM match_kpis WHERE user_id='ana'").fetchone() == (1, 1, 4)
+    conn.close()
+
+    # A DB única fica intacta
+    legacy = sqlite3.connect(app["DB_FILE"])
+    assert legacy.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert legacy.execute("SELECT count(*) FROM matches").fetchone()[0] == 3
+    legacy.close()
+    assert sorted(os.listdir(tmp_path)) == ["gk_master.db", "gk_user_ana.db"]
+
+
+def test_failed_split_leaves_no_shard(legacy_app, tmp_path):
+    app = legacy_app
+    add_legacy_rows(app["DB_FILE"])
+    shard = str(tmp_path / "gk_user_ana.db")
+
+    def boom(c, user=None):
+        raise sqlite3.IntegrityError("falha simulada")
+    app["rebuild_match_kpis"] = boom
+
+    with pytest.raises(sqlite3.IntegrityError):
+        app["split_user_shard"]("ana", shard)
+    assert sorted(os.listdir(tmp_path)) == ["gk_master.db"]
@@ -0,0 +1,34 @@
+"""O worker de envio sobrevive a erros da própria outbox."""
+import sqlite3
+import time
+
+
+def test_worker_keeps_running_when_outbox_is_locked(app, tmp_path):
+    app["RETRY_BASE_S"] = 0.01
+    locked = []
+
+    class LockedOutbox(app["SyncOutbox"]):
+        def failed(self, job, error):
+            if not locked:
+                locked.append(job["id"])
+                raise sqlite3.OperationalError("database is locked")
+            super().failed(job, error)
+
+    runs = []
+
+    def flaky_blobs(job):
+        runs.append(job["id"])
+        if len(runs) == 1:
+            raise RuntimeError("Drive indisponível")
+
+    worker = app["UploadWorker"](app["UPLOAD_QUEUE_SIZE"], LockedOutbox(str(tmp_path / "gk_sync_outbox.db")))
+    worker.handlers["blob"] = flaky_blobs
+    worker.submit("blob", "gk_blobs.db", "novos ficheiros")
+
+    deadline = time.monotonic() + 5
+    while worker.outbox.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert worker.thread.is_alive()
+    assert worker.outbox.pending() == 0 and len(runs) == 2
+    assert "database is locked" in worker.last_error[1]